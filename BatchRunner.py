@@ -0,0 +1,179 @@
+import asyncio
+import json
+import os
+import time
+
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+
+from LLMAgent import CallInfo, LLMAgent, LLMResponse
+from ModelBackend import ModelBackend
+from RequestScheduler import estimate_prompt_tokens
+
+BATCH_DIR = "data/batches/"
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+DEFAULT_POLL_INTERVAL = 30.
+
+
+class BatchTransport:
+    async def run(self, batch_file_path: str) -> list[dict]:
+        raise NotImplementedError
+
+
+class OpenAIBatchTransport(BatchTransport):
+    def __init__(self, client: AsyncOpenAI, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        self.client = client
+        self.poll_interval = poll_interval
+
+    async def run(self, batch_file_path: str) -> list[dict]:
+        with open(batch_file_path, 'rb') as f:
+            batch_input_file = await self.client.files.create(file=f, purpose="batch")
+
+        batch = await self.client.batches.create(
+            input_file_id=batch_input_file.id,
+            endpoint=CHAT_COMPLETIONS_ENDPOINT,
+            completion_window="24h",
+        )
+        print(f"Submitted batch {batch.id} ({batch_file_path})")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(self.poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+
+        if batch.status != "completed" or batch.output_file_id is None:
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+        batch_output = await self.client.files.content(batch.output_file_id)
+        return [json.loads(line) for line in batch_output.text.splitlines() if line.strip()]
+
+
+class LocalBatchTransport(BatchTransport):
+    # Stand-in for the batch API: sends every request of the batch file to a model backend and returns the results
+    # in the batch output format
+    def __init__(self, backend: ModelBackend, concurrency: int = 8):
+        self.backend = backend
+        self.concurrency = concurrency
+
+    async def run(self, batch_file_path: str) -> list[dict]:
+        with open(batch_file_path, 'r') as f:
+            batch_requests = [json.loads(line) for line in f if line.strip()]
+
+        concurrency_limit = asyncio.Semaphore(self.concurrency)
+
+        async def run_request(batch_request: dict) -> dict:
+            async with concurrency_limit:
+                try:
+                    body = dict(batch_request["body"])
+                    completion = await self.backend.create_completion(body.pop("model"), body.pop("messages"), body)
+                except Exception as e:
+                    # reported like a failed request of the batch API, so that the other results are kept
+                    return {
+                        "custom_id": batch_request["custom_id"],
+                        "response": None,
+                        "error": {"message": repr(e)},
+                    }
+            return {
+                "custom_id": batch_request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": completion.model_dump(),
+                },
+                "error": None,
+            }
+
+        return list(await asyncio.gather(*map(run_request, batch_requests)))
+
+
+class BatchRunner:
+    def __init__(self, agent: LLMAgent, transport: BatchTransport, batch_dir: str = BATCH_DIR):
+        self.agent = agent
+        self.transport = transport
+        self.batch_dir = batch_dir
+
+    async def get_responses(self, batch_name: str, requests: dict[str, list[dict[str, str]]],
+                            call_infos: dict[str, CallInfo] | None = None) -> dict[str, LLMResponse]:
+        # call_infos label the telemetry records of the requests, every request gets one like an unbatched call
+        call_infos = call_infos if call_infos is not None else {}
+        responses = {}
+        cache_keys = {}
+        if self.agent.cache is not None:
+            for custom_id, messages in requests.items():
+                started_at = time.time()
+                start_time = time.perf_counter()
+                cache_keys[custom_id] = self.agent.get_cache_key(messages)
+                cached_response = self.agent.cache.get(cache_keys[custom_id])
+                if cached_response is not None:
+                    responses[custom_id] = LLMResponse(cached_response, from_cache=True)
+                    self.agent.record_call(call_infos.get(custom_id), started_at, time.perf_counter() - start_time,
+                                           responses[custom_id])
+
+        missing_requests = {custom_id: messages for custom_id, messages in requests.items()
+                            if custom_id not in responses}
+        if not missing_requests:
+            return responses
+
+        # the batch does not pass through the scheduler, but its estimated cost counts against the same spend ceiling
+        scheduler = self.agent.scheduler
+        reserved_cost = 0.
+        started_at = time.time()
+        start_time = time.perf_counter()
+        try:
+            if scheduler is not None:
+                for messages in missing_requests.values():
+                    reserved_cost += scheduler.reserve_spend(self.agent.model, estimate_prompt_tokens(messages))
+            batch_file_path = self.write_batch_file(batch_name, missing_requests)
+            batch_results = await self.transport.run(batch_file_path)
+        finally:
+            if scheduler is not None:
+                scheduler.release_spend(reserved_cost)
+
+        # the requests of a batch are only timed together, from submitting the batch to receiving its results
+        wall_time = time.perf_counter() - start_time
+        failed_results = []
+        for batch_result in batch_results:
+            custom_id = batch_result["custom_id"]
+            if batch_result.get("error") or batch_result["response"]["status_code"] != 200:
+                failed_results.append(batch_result)
+                self.agent.record_call(call_infos.get(custom_id), started_at, wall_time,
+                                       error=RuntimeError(batch_result.get("error") or batch_result["response"]))
+                continue
+
+            completion = ChatCompletion.model_validate(batch_result["response"]["body"])
+            responses[custom_id] = self.agent.get_llm_response(completion)
+            self.agent.record_usage(responses[custom_id])
+            self.agent.record_call(call_infos.get(custom_id), started_at, wall_time, responses[custom_id])
+            if scheduler is not None:
+                scheduler.record_spend(self.agent.model, responses[custom_id].prompt_tokens,
+                                       responses[custom_id].cached_tokens, responses[custom_id].completion_tokens)
+            if self.agent.cache is not None:
+                self.agent.cache.put(cache_keys[custom_id], responses[custom_id].content)
+
+        # raised only after the successful results are cached, so that a rerun does not pay for them again
+        if failed_results:
+            raise RuntimeError(f"{len(failed_results)} requests of batch {batch_name} failed, "
+                               f"the first one: {failed_results[0]}")
+
+        missing_responses = requests.keys() - responses.keys()
+        if missing_responses:
+            raise RuntimeError(f"Batch {batch_name} returned no response for {sorted(missing_responses)}")
+
+        return responses
+
+    def write_batch_file(self, batch_name: str, requests: dict[str, list[dict[str, str]]]) -> str:
+        if not os.path.isdir(self.batch_dir):
+            os.makedirs(self.batch_dir)
+
+        batch_file_path = os.path.join(self.batch_dir, f"{batch_name}_{int(time.time())}.jsonl")
+        with open(batch_file_path, 'w+') as f:
+            for custom_id, messages in requests.items():
+                f.write(json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": CHAT_COMPLETIONS_ENDPOINT,
+                    "body": {
+                        "model": self.agent.model,
+                        "messages": messages,
+                        **self.agent.sampling_params,
+                    },
+                }, ensure_ascii=False) + "\n")
+        return batch_file_path
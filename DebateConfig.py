@@ -0,0 +1,128 @@
+import difflib
+import re
+from dataclasses import dataclass, field
+from typing import Callable
+
+from Transcript import Transcript
+from judge_sampling import DEFAULT_JUDGE_CONFIDENCE
+
+NUM_DEBATE_ROUNDS = 3
+
+# simultaneous: all debaters of a round answer in parallel and only see the previous rounds
+# sequential: debaters answer one after another and see the arguments already given in the current round
+TURN_ORDER_SIMULTANEOUS = "simultaneous"
+TURN_ORDER_SEQUENTIAL = "sequential"
+TURN_ORDERS = (TURN_ORDER_SIMULTANEOUS, TURN_ORDER_SEQUENTIAL)
+
+# essay: the judge reasons in <thinking> tags before its "Answer: <A|B>"
+# logprobs: the judge answers with a single letter, the logprobs of that token give the probability of answer A
+JUDGE_MODE_ESSAY = "essay"
+JUDGE_MODE_LOGPROBS = "logprobs"
+JUDGE_MODES = (JUDGE_MODE_ESSAY, JUDGE_MODE_LOGPROBS)
+
+CONCESSION_PATTERN = re.compile(r"\b(i concede|i agree with my opponent|my opponent is (right|correct))\b",
+                                re.IGNORECASE)
+REPETITION_SIMILARITY_THRESHOLD = .9
+
+
+def get_latest_arguments(transcript: Transcript) -> list[tuple[str | None, str | None]]:
+    # (previous argument, latest argument) of every debater
+    if transcript.num_rounds == 0:
+        return []
+
+    latest_arguments = []
+    for agent_id in transcript.agent_ids:
+        previous_argument = None
+        if transcript.num_rounds > 1:
+            previous_argument = transcript.arguments[agent_id][transcript.num_rounds - 2]
+        latest_arguments.append((previous_argument, transcript.arguments[agent_id][transcript.num_rounds - 1]))
+    return latest_arguments
+
+
+def all_debaters_concede(transcript: Transcript) -> bool:
+    latest_arguments = get_latest_arguments(transcript)
+    return bool(latest_arguments) and all(
+        latest_argument is not None and CONCESSION_PATTERN.search(latest_argument)
+        for _, latest_argument in latest_arguments
+    )
+
+
+def all_debaters_repeat(transcript: Transcript) -> bool:
+    latest_arguments = get_latest_arguments(transcript)
+    return bool(latest_arguments) and all(
+        previous_argument is not None and latest_argument is not None
+        and difflib.SequenceMatcher(None, previous_argument, latest_argument).ratio()
+        >= REPETITION_SIMILARITY_THRESHOLD
+        for previous_argument, latest_argument in latest_arguments
+    )
+
+
+def all_debaters_concede_or_repeat(transcript: Transcript) -> bool:
+    return all_debaters_concede(transcript) or all_debaters_repeat(transcript)
+
+
+STOPPING_CONDITIONS = {
+    "concede": all_debaters_concede,
+    "repeat": all_debaters_repeat,
+    "concede_or_repeat": all_debaters_concede_or_repeat,
+}
+
+
+def get_participants(debaters_per_side: int = 1) -> dict[str, bool]:
+    # agent id -> whether the agent argues for the correct answer, the sides take turns in sequential debates
+    participants = {}
+    for debater_number in range(1, debaters_per_side + 1):
+        suffix = "" if debater_number == 1 else f"_{debater_number}"
+        participants[f"correct_agent{suffix}"] = True
+        participants[f"false_agent{suffix}"] = False
+    return participants
+
+
+@dataclass
+class DebateConfig:
+    num_rounds: int = NUM_DEBATE_ROUNDS
+    participants: dict[str, bool] = field(default_factory=get_participants)
+    turn_order: str = TURN_ORDER_SIMULTANEOUS
+    # checked after every round, the debate ends early once it returns True
+    stopping_condition: Callable[[Transcript], bool] | None = None
+    # at most this many verdicts per judge ordering, sampling stops early once the majority reaches judge_confidence
+    judge_samples: int = 1
+    judge_confidence: float = DEFAULT_JUDGE_CONFIDENCE
+    judge_mode: str = JUDGE_MODE_ESSAY
+
+    def __post_init__(self):
+        if self.num_rounds < 1:
+            raise ValueError("A debate needs at least one round")
+        if self.turn_order not in TURN_ORDERS:
+            raise ValueError(f"Unknown turn order: {self.turn_order}")
+        if set(self.participants.values()) != {True, False}:
+            raise ValueError("Both answers need at least one debater")
+        if self.judge_samples < 1:
+            raise ValueError("The judge needs at least one sample per ordering")
+        if not .5 < self.judge_confidence < 1:
+            raise ValueError("The judge confidence has to be between 0.5 and 1")
+        if self.judge_mode not in JUDGE_MODES:
+            raise ValueError(f"Unknown judge mode: {self.judge_mode}")
+        if self.judge_mode == JUDGE_MODE_LOGPROBS and self.judge_samples > 1:
+            raise ValueError("The logprobs of a single judge sample already give the probability of both answers")
+
+    def get_directory_name(self) -> str:
+        # the files of differently configured debates must not be mistaken for each other. Debates with the default
+        # configuration keep the directories of the earlier runs, the others get a subdirectory per configuration
+        name_parts = []
+        if self.num_rounds != NUM_DEBATE_ROUNDS:
+            name_parts.append(f"rounds_{self.num_rounds}")
+        if self.participants != get_participants():
+            name_parts.append(f"debaters_{len(self.get_side(True))}v{len(self.get_side(False))}")
+        if self.turn_order != TURN_ORDER_SIMULTANEOUS:
+            name_parts.append(self.turn_order)
+        if self.stopping_condition is not None:
+            stopping_condition_name = next((name for name, stopping_condition in STOPPING_CONDITIONS.items()
+                                            if stopping_condition is self.stopping_condition),
+                                           self.stopping_condition.__name__)
+            name_parts.append(f"stop_{stopping_condition_name}")
+        return "-".join(name_parts)
+
+    def get_side(self, argues_for_correct_answer: bool) -> tuple[str, ...]:
+        return tuple(agent_id for agent_id, is_correct in self.participants.items()
+                     if is_correct == argues_for_correct_answer)
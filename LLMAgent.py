@@ -1,24 +1,246 @@
-from openai import OpenAI
+import json
+import re
+import time
+from dataclasses import asdict, dataclass, fields
+
+from openai import AsyncOpenAI
+
+from ModelBackend import ModelBackend, OpenAIBackend
+from RequestScheduler import CHARACTERS_PER_TOKEN, MODEL_PRICES, RequestScheduler, estimate_prompt_tokens, get_cost
+from ResponseCache import ResponseCache
+from Telemetry import TelemetrySink
+
+DEFAULT_MODEL = "gpt-4o-mini"
+# a stop pattern may be split over several chunks, so the search starts this many characters before the new chunk
+STOP_PATTERN_LOOKBEHIND = 32
+
+
+@dataclass
+class CallInfo:
+    # where in the experiment a request belongs, used by the replay backend and the telemetry
+    question_id: int
+    condition: str
+    role: str
+    debate_round: int | None = None
+    judge_ordering: str | None = None
+    # repeated judge verdicts for the same prompt, every sample is a separate request
+    sample_index: int = 0
+
+
+@dataclass
+class LLMResponse:
+    content: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    latency: float | None = None
+    from_cache: bool = False
+    time_to_first_token: float | None = None
+    time_to_stop_pattern: float | None = None
+    queue_time: float = 0.
+    retries: int = 0
+    # the generation was cancelled after the stop pattern, the token counts are estimates
+    stopped_early: bool = False
+    # logprobs of the most likely first tokens, only for requests with top_logprobs
+    top_logprobs: dict[str, float] | None = None
 
 
 class LLMAgent:
-    def __init__(self):
-        api_keys = {}
-        with open("SECRETS", "r") as f:
-            for line in f.readlines():
-                line = line.split("=")
-                api_keys[line[0]] = line[1].rstrip()
+    def __init__(self, client: AsyncOpenAI | None = None, cache: ResponseCache | None = None,
+                 model: str = DEFAULT_MODEL, sampling_params: dict | None = None,
+                 scheduler: RequestScheduler | None = None, stream: bool = False,
+                 backend: ModelBackend | None = None, telemetry: TelemetrySink | None = None):
+        self.backend = backend if backend is not None else OpenAIBackend(client)
+        self.cache = cache
+        self.model = model
+        self.sampling_params = sampling_params if sampling_params is not None else {}
+        self.scheduler = scheduler
+        self.stream = stream
+        self.telemetry = telemetry
+        self.usage_records: list[dict[str, int]] = []
 
-        self.open_ai_client = OpenAI(
-            api_key=api_keys["OPEN_AI_API_KEY"]
-        )
+    async def get_response(self, messages: list[dict[str, str]], stop_pattern: re.Pattern | None = None,
+                           call_info: CallInfo | None = None) -> str:
+        return (await self.get_completion(messages, stop_pattern, call_info)).content
+
+    def get_sampling_params(self, sampling_params: dict | None = None) -> dict:
+        # sampling parameters of a single request override the ones of the agent
+        return self.sampling_params if sampling_params is None else self.sampling_params | sampling_params
+
+    def get_cache_key(self, messages: list[dict[str, str]], sample_index: int = 0,
+                      sampling_params: dict | None = None) -> str:
+        model = self.model
+        if self.backend.cache_namespace is not None:
+            model = f"{self.backend.cache_namespace}/{model}"
+        sampling_params = self.get_sampling_params(sampling_params)
+        # the first sample keeps the key it had before judges were sampled repeatedly
+        if sample_index > 0:
+            sampling_params = sampling_params | {"sample_index": sample_index}
+        return ResponseCache.get_key(model, messages, sampling_params)
+
+    async def get_completion(self, messages: list[dict[str, str]], stop_pattern: re.Pattern | None = None,
+                             call_info: CallInfo | None = None, sampling_params: dict | None = None) -> LLMResponse:
+        # when streaming, the generation is cancelled as soon as stop_pattern matches the response
+        started_at = time.time()
+        start_time = time.perf_counter()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.get_cache_key(messages, call_info.sample_index if call_info is not None else 0,
+                                           sampling_params)
+            cached_response = self.cache.get(cache_key)
+            if cached_response is not None:
+                response = self.get_cached_response(cached_response, sampling_params)
+                self.record_call(call_info, started_at, time.perf_counter() - start_time, response)
+                return response
+
+        try:
+            if self.scheduler is None:
+                response = await self.request_completion(self.backend, messages, stop_pattern, call_info,
+                                                         sampling_params)
+            else:
+                # the scheduler retries itself, the retries of the client would bypass its rate limits
+                backend = self.backend.without_retries()
+                response = await self.scheduler.run(
+                    self.model, messages,
+                    lambda: self.request_completion(backend, messages, stop_pattern, call_info, sampling_params))
+        except Exception as e:
+            self.record_call(call_info, started_at, time.perf_counter() - start_time, error=e)
+            raise
+        self.record_usage(response)
+        self.record_call(call_info, started_at, time.perf_counter() - start_time, response)
+
+        if self.cache is not None:
+            self.cache.put(cache_key, self.get_cache_entry(response))
+
+        return response
 
-    def get_response(self, messages: list[dict[str, str]]) -> str:
-        response = self.open_ai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages
-        ).choices[0].message.content
+    @staticmethod
+    def get_cache_entry(response: LLMResponse) -> str:
+        # the logprobs are cached together with the content, plain responses stay plain text
+        if response.top_logprobs is None:
+            return response.content
+        return json.dumps({"content": response.content, "top_logprobs": response.top_logprobs})
 
-        # response = "<thinking></thinking> <argument></argument>"
+    def get_cached_response(self, cache_entry: str, sampling_params: dict | None = None) -> LLMResponse:
+        if "top_logprobs" not in self.get_sampling_params(sampling_params):
+            return LLMResponse(cache_entry, from_cache=True)
+        cached_response = json.loads(cache_entry)
+        return LLMResponse(cached_response["content"], from_cache=True, top_logprobs=cached_response["top_logprobs"])
 
+    async def request_completion(self, backend: ModelBackend, messages: list[dict[str, str]],
+                                 stop_pattern: re.Pattern | None = None, call_info: CallInfo | None = None,
+                                 sampling_params: dict | None = None) -> LLMResponse:
+        start_time = time.perf_counter()
+        sampling_params = self.get_sampling_params(sampling_params)
+        # the logprobs are only read from complete responses
+        if self.stream and "top_logprobs" not in sampling_params:
+            response = await self.stream_completion(backend, messages, stop_pattern, call_info, start_time,
+                                                    sampling_params)
+        else:
+            completion = await backend.create_completion(self.model, messages, sampling_params, call_info)
+            response = self.get_llm_response(completion)
+        response.latency = time.perf_counter() - start_time
         return response
+
+    async def stream_completion(self, backend: ModelBackend, messages: list[dict[str, str]],
+                                stop_pattern: re.Pattern | None, call_info: CallInfo | None,
+                                start_time: float, sampling_params: dict) -> LLMResponse:
+        stream = await backend.stream_completion(self.model, messages, sampling_params, call_info)
+
+        response = LLMResponse("")
+        usage = None
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+
+                if response.time_to_first_token is None:
+                    response.time_to_first_token = time.perf_counter() - start_time
+                search_start = max(0, len(response.content) - STOP_PATTERN_LOOKBEHIND)
+                response.content += chunk.choices[0].delta.content
+
+                stop_match = stop_pattern.search(response.content, search_start) if stop_pattern else None
+                if stop_match:
+                    response.time_to_stop_pattern = time.perf_counter() - start_time
+                    response.content = response.content[:stop_match.end()]
+                    response.stopped_early = True
+                    break
+        finally:
+            # closing the stream early cancels the generation on the server
+            await stream.aclose()
+
+        if usage is not None:
+            self.set_usage(response, usage)
+        else:
+            # the usage is only sent at the end of a complete stream
+            response.prompt_tokens = estimate_prompt_tokens(messages)
+            response.completion_tokens = len(response.content) // CHARACTERS_PER_TOKEN
+        return response
+
+    @staticmethod
+    def get_llm_response(completion) -> LLMResponse:
+        response = LLMResponse(completion.choices[0].message.content)
+        logprobs = completion.choices[0].logprobs
+        if logprobs is not None and logprobs.content:
+            response.top_logprobs = {top_logprob.token: top_logprob.logprob
+                                     for top_logprob in logprobs.content[0].top_logprobs}
+        if completion.usage is not None:
+            LLMAgent.set_usage(response, completion.usage)
+        return response
+
+    @staticmethod
+    def set_usage(response: LLMResponse, usage):
+        response.prompt_tokens = usage.prompt_tokens
+        response.completion_tokens = usage.completion_tokens
+        if usage.prompt_tokens_details is not None and usage.prompt_tokens_details.cached_tokens is not None:
+            response.cached_tokens = usage.prompt_tokens_details.cached_tokens
+
+    def record_usage(self, response: LLMResponse):
+        self.usage_records.append({
+            "prompt_tokens": response.prompt_tokens,
+            "cached_tokens": response.cached_tokens,
+            "completion_tokens": response.completion_tokens,
+        })
+
+    def record_call(self, call_info: CallInfo | None, started_at: float, wall_time: float,
+                    response: LLMResponse | None = None, error: Exception | None = None):
+        if self.telemetry is None:
+            return
+
+        record = asdict(call_info) if call_info is not None else dict.fromkeys(
+            call_info_field.name for call_info_field in fields(CallInfo))
+        record.update({
+            "started_at": started_at,
+            "wall_time": wall_time,
+            "model": self.model,
+            "backend": type(self.backend).__name__,
+            "error": repr(error) if error is not None else None,
+        })
+        if response is not None:
+            record.update({
+                "queue_time": response.queue_time,
+                "latency": response.latency,
+                "time_to_first_token": response.time_to_first_token,
+                "retries": response.retries,
+                "from_cache": response.from_cache,
+                "stopped_early": response.stopped_early,
+                "prompt_tokens": response.prompt_tokens,
+                "cached_tokens": response.cached_tokens,
+                "completion_tokens": response.completion_tokens,
+                "cost": get_cost(self.model, response.prompt_tokens, response.cached_tokens,
+                                 response.completion_tokens) if self.model in MODEL_PRICES else None,
+            })
+        self.telemetry.add_record(record)
+
+    def get_usage_summary(self) -> dict[str, int | float]:
+        prompt_tokens = sum(record["prompt_tokens"] for record in self.usage_records)
+        cached_tokens = sum(record["cached_tokens"] for record in self.usage_records)
+        return {
+            "calls": len(self.usage_records),
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": sum(record["completion_tokens"] for record in self.usage_records),
+            "cached_token_share": cached_tokens / prompt_tokens if prompt_tokens else 0.,
+        }
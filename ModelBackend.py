@@ -0,0 +1,272 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+from typing import AsyncIterator
+
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from RequestScheduler import CHARACTERS_PER_TOKEN, estimate_prompt_tokens
+from llm_clients import get_client
+
+STORY_PATTERN = re.compile(r"<story>\s*([\s\S]*?)\s*</story>")
+JUDGE_PROMPT_MARKER = "Answer: <A|B>"
+WORD_WITH_WHITESPACE_PATTERN = re.compile(r"\s*\S+\s*$|\s*\S+")
+
+DEFAULT_LATENCY_MEDIAN = 2.
+DEFAULT_LATENCY_SIGMA = .4
+DEFAULT_TIME_TO_FIRST_TOKEN_SHARE = .15
+DEFAULT_COMPLETION_WORDS_MEDIAN = 180
+DEFAULT_COMPLETION_WORDS_SIGMA = .3
+SYNTHETIC_QUOTES_PER_ARGUMENT = 2
+SYNTHETIC_WORDS_PER_CHUNK = 3
+SYNTHETIC_VOCABULARY = ("the", "story", "clearly", "shows", "that", "my", "answer", "opponent", "evidence", "because",
+                        "judge", "should", "consider", "character", "argument", "text", "however", "this", "is",
+                        "not", "supported", "by", "quote", "which", "proves", "context", "question", "correct")
+
+
+class ModelBackend:
+    # identifies the backend in response cache keys, None keeps the keys of plain OpenAI requests
+    cache_namespace: str | None = None
+
+    async def create_completion(self, model: str, messages: list[dict[str, str]], sampling_params: dict,
+                                call_info=None) -> ChatCompletion:
+        raise NotImplementedError
+
+    async def stream_completion(self, model: str, messages: list[dict[str, str]], sampling_params: dict,
+                                call_info=None) -> AsyncIterator[ChatCompletionChunk]:
+        # the returned stream has to support aclose(), which cancels the generation
+        raise NotImplementedError
+
+    def without_retries(self) -> "ModelBackend":
+        return self
+
+
+class OpenAIBackend(ModelBackend):
+    def __init__(self, client: AsyncOpenAI | None = None):
+        self.client = client if client is not None else get_client()
+
+    async def create_completion(self, model: str, messages: list[dict[str, str]], sampling_params: dict,
+                                call_info=None) -> ChatCompletion:
+        return await self.client.chat.completions.create(model=model, messages=messages, **sampling_params)
+
+    async def stream_completion(self, model: str, messages: list[dict[str, str]], sampling_params: dict,
+                                call_info=None) -> AsyncIterator[ChatCompletionChunk]:
+        return await self.client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                         stream_options={"include_usage": True}, **sampling_params)
+
+    def without_retries(self) -> "OpenAIBackend":
+        return OpenAIBackend(self.client.with_options(max_retries=0))
+
+
+class OpenAICompatibleBackend(OpenAIBackend):
+    # local servers like vLLM or llama.cpp that implement the chat completions endpoint
+    def __init__(self, base_url: str, api_key_name: str | None = None):
+        super().__init__(get_client(api_key_name, base_url))
+        self.cache_namespace = base_url
+
+
+def get_completion_text_chunks(text: str) -> list[str]:
+    words = WORD_WITH_WHITESPACE_PATTERN.findall(text)
+    return ["".join(words[i:i + SYNTHETIC_WORDS_PER_CHUNK]) for i in range(0, len(words), SYNTHETIC_WORDS_PER_CHUNK)]
+
+
+def make_completion(model: str, content: str, prompt_tokens: int, completion_tokens: int,
+                    top_logprobs: dict[str, float] | None = None) -> ChatCompletion:
+    # with top_logprobs, content is a single token
+    logprobs = None
+    if top_logprobs is not None:
+        logprobs = {"content": [{
+            "token": content, "logprob": top_logprobs[content], "bytes": None,
+            "top_logprobs": [{"token": token, "logprob": logprob, "bytes": None}
+                             for token, logprob in top_logprobs.items()],
+        }]}
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-offline",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content},
+                     "logprobs": logprobs}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    })
+
+
+def make_chunk(model: str, content: str | None = None, usage: dict | None = None) -> ChatCompletionChunk:
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-offline",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if content is None else [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+        "usage": usage,
+    })
+
+
+class OfflineBackend(ModelBackend):
+    # serves generated or recorded responses with a simulated latency, without any network access
+    def __init__(self, latency_median: float, latency_sigma: float,
+                 time_to_first_token_share: float = DEFAULT_TIME_TO_FIRST_TOKEN_SHARE):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.time_to_first_token_share = time_to_first_token_share
+        self.seed = None
+
+    def get_content(self, messages: list[dict[str, str]], rng: random.Random, call_info) -> str:
+        raise NotImplementedError
+
+    def get_top_logprobs(self, messages: list[dict[str, str]], rng: random.Random, call_info) -> dict[str, float]:
+        raise NotImplementedError
+
+    @staticmethod
+    def get_rng(model: str, messages: list[dict[str, str]], sampling_params: dict, seed,
+                call_info=None) -> random.Random:
+        # the same request always gets the same response and latency, repeated samples of it get different ones
+        request = [seed, model, messages, sampling_params]
+        if call_info is not None and call_info.sample_index > 0:
+            request.append(call_info.sample_index)
+        request = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return random.Random(hashlib.sha256(request.encode()).digest())
+
+    def get_latency(self, rng: random.Random) -> float:
+        if self.latency_median <= 0:
+            return 0.
+        return rng.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+    @staticmethod
+    def get_token_counts(messages: list[dict[str, str]], content: str) -> tuple[int, int]:
+        return estimate_prompt_tokens(messages), len(content) // CHARACTERS_PER_TOKEN
+
+    async def create_completion(self, model: str, messages: list[dict[str, str]], sampling_params: dict,
+                                call_info=None) -> ChatCompletion:
+        rng = self.get_rng(model, messages, sampling_params, self.seed, call_info)
+        if "top_logprobs" in sampling_params:
+            # a single token completion, the most likely token is the response
+            top_logprobs = self.get_top_logprobs(messages, rng, call_info)
+            content = max(top_logprobs, key=top_logprobs.get)
+            await asyncio.sleep(self.get_latency(rng) * self.time_to_first_token_share)
+            return make_completion(model, content, estimate_prompt_tokens(messages), 1, top_logprobs)
+
+        content = self.get_content(messages, rng, call_info)
+        await asyncio.sleep(self.get_latency(rng))
+        return make_completion(model, content, *self.get_token_counts(messages, content))
+
+    async def stream_completion(self, model: str, messages: list[dict[str, str]], sampling_params: dict,
+                                call_info=None) -> AsyncIterator[ChatCompletionChunk]:
+        rng = self.get_rng(model, messages, sampling_params, self.seed, call_info)
+        content = self.get_content(messages, rng, call_info)
+        latency = self.get_latency(rng)
+        prompt_tokens, completion_tokens = self.get_token_counts(messages, content)
+
+        async def generate_chunks() -> AsyncIterator[ChatCompletionChunk]:
+            await asyncio.sleep(latency * self.time_to_first_token_share)
+            text_chunks = get_completion_text_chunks(content)
+            for text_chunk in text_chunks:
+                yield make_chunk(model, text_chunk)
+                await asyncio.sleep(latency * (1 - self.time_to_first_token_share) / len(text_chunks))
+            yield make_chunk(model, usage={"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                           "total_tokens": prompt_tokens + completion_tokens})
+
+        return generate_chunks()
+
+
+class SyntheticBackend(OfflineBackend):
+    # deterministic fake debaters and judges with configurable latency and length distributions, for load tests
+    def __init__(self, seed: int = 0, latency_median: float = DEFAULT_LATENCY_MEDIAN,
+                 latency_sigma: float = DEFAULT_LATENCY_SIGMA,
+                 completion_words_median: int = DEFAULT_COMPLETION_WORDS_MEDIAN,
+                 completion_words_sigma: float = DEFAULT_COMPLETION_WORDS_SIGMA,
+                 time_to_first_token_share: float = DEFAULT_TIME_TO_FIRST_TOKEN_SHARE):
+        super().__init__(latency_median, latency_sigma, time_to_first_token_share)
+        self.seed = seed
+        self.completion_words_median = completion_words_median
+        self.completion_words_sigma = completion_words_sigma
+        self.cache_namespace = f"synthetic-{seed}"
+        self.story_words: dict[str, list[str]] = {}
+
+    def get_words(self, rng: random.Random, num_words: int) -> str:
+        return " ".join(rng.choice(SYNTHETIC_VOCABULARY) for _ in range(max(1, num_words)))
+
+    def get_story_words(self, messages: list[dict[str, str]]) -> list[str]:
+        for message in messages:
+            story_match = STORY_PATTERN.search(message["content"])
+            if story_match:
+                story = story_match.group(1)
+                if story not in self.story_words:
+                    self.story_words[story] = story.split()
+                return self.story_words[story]
+        return []
+
+    def get_content(self, messages: list[dict[str, str]], rng: random.Random, call_info) -> str:
+        num_words = max(10, int(rng.lognormvariate(math.log(self.completion_words_median),
+                                                   self.completion_words_sigma)))
+        if JUDGE_PROMPT_MARKER in messages[-1]["content"]:
+            return f"<thinking>{self.get_words(rng, num_words)}</thinking>\nAnswer: {rng.choice('AB')}"
+
+        story_words = self.get_story_words(messages)
+        argument = self.get_words(rng, num_words // 4)
+        for _ in range(SYNTHETIC_QUOTES_PER_ARGUMENT):
+            if story_words:
+                start = rng.randrange(max(1, len(story_words) - 12))
+                argument += f" <quote>{' '.join(story_words[start:start + rng.randint(4, 12)])}</quote> "
+            argument += self.get_words(rng, num_words // 8)
+        return f"<thinking>{self.get_words(rng, num_words // 2)}</thinking> <argument>{argument}</argument>"
+
+    def get_top_logprobs(self, messages: list[dict[str, str]], rng: random.Random, call_info) -> dict[str, float]:
+        probability_a = rng.uniform(.01, .99)
+        return {"A": math.log(probability_a), "B": math.log(1 - probability_a)}
+
+
+class ReplayBackend(OfflineBackend):
+    # serves the responses of an earlier run from its conversation and judge result files, requires call infos
+    def __init__(self, conversations_dir: str, judge_results_dir: str, latency_median: float = 0.,
+                 latency_sigma: float = DEFAULT_LATENCY_SIGMA):
+        super().__init__(latency_median, latency_sigma)
+        self.conversations_dir = conversations_dir
+        self.judge_results_dir = judge_results_dir
+        self.cache_namespace = f"replay-{os.path.abspath(conversations_dir)}"
+        self.loaded_files: dict[str, dict] = {}
+
+    def load_file(self, file_path: str) -> dict:
+        if file_path not in self.loaded_files:
+            with open(file_path, 'r') as f:
+                self.loaded_files[file_path] = json.load(f)
+        return self.loaded_files[file_path]
+
+    def get_content(self, messages: list[dict[str, str]], rng: random.Random, call_info) -> str:
+        if call_info is None:
+            raise ValueError("The replay backend needs the call info of every request")
+
+        file_name = f"{call_info.condition}_{call_info.question_id}.json"
+        if call_info.judge_ordering is not None:
+            judge_results = self.load_file(os.path.join(self.judge_results_dir, file_name))
+            if call_info.sample_index == 0:
+                return judge_results[call_info.judge_ordering]
+            judge_samples = judge_results.get("samples", {}).get(call_info.judge_ordering, [])
+            if call_info.sample_index >= len(judge_samples):
+                raise ValueError(f"No recorded response for {call_info}")
+            return judge_samples[call_info.sample_index]
+
+        agent_messages = self.load_file(os.path.join(self.conversations_dir, file_name))[call_info.role]
+        if call_info.debate_round >= len(agent_messages):
+            raise ValueError(f"No recorded response for {call_info}")
+        return agent_messages[call_info.debate_round]
+
+    def get_top_logprobs(self, messages: list[dict[str, str]], rng: random.Random, call_info) -> dict[str, float]:
+        if call_info is None or call_info.judge_ordering is None:
+            raise ValueError("The replay backend only has recorded logprobs for judges")
+
+        judge_results = self.load_file(os.path.join(self.judge_results_dir,
+                                                    f"{call_info.condition}_{call_info.question_id}.json"))
+        probability_a = judge_results.get("probabilities", {}).get(call_info.judge_ordering)
+        if probability_a is None:
+            raise ValueError(f"No recorded answer probability for {call_info}")
+        # the recorded probability was normalized over both answers, so only these two tokens are replayed
+        answer_probabilities = {"A": probability_a, "B": 1 - probability_a}
+        return {answer: math.log(probability) for answer, probability in answer_probabilities.items() if probability > 0}
@@ -0,0 +1,41 @@
+import re
+
+SLOT_PATTERN = re.compile(r"\[([A-Z][A-Z0-9_]*)]")
+
+
+class PromptTemplate:
+    def __init__(self, template: str, slots: tuple[str, ...] | None = None):
+        self.template = template
+        self.segments: list[str] = []
+        self.slot_positions: dict[str, list[int]] = {}
+
+        # split the template once into literal segments with empty placeholders for every slot
+        position = 0
+        for slot in SLOT_PATTERN.finditer(template):
+            slot_name = slot.group(1)
+            if slots is not None and slot_name not in slots:
+                continue
+
+            self.segments.append(template[position:slot.start()])
+            self.slot_positions.setdefault(slot_name, []).append(len(self.segments))
+            self.segments.append("")
+            position = slot.end()
+        self.segments.append(template[position:])
+
+        if slots is not None:
+            missing_slots = set(slots) - self.slot_positions.keys()
+            if missing_slots:
+                raise ValueError(f"Slots {sorted(missing_slots)} not found in template")
+
+    @property
+    def slot_names(self) -> set[str]:
+        return set(self.slot_positions.keys())
+
+    def render(self, **values: str) -> str:
+        segments = self.segments.copy()
+        for slot_name, positions in self.slot_positions.items():
+            if slot_name not in values:
+                raise KeyError(f"No value given for template slot [{slot_name}]")
+            for position in positions:
+                segments[position] = values[slot_name]
+        return "".join(segments)
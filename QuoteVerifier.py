@@ -0,0 +1,131 @@
+import re
+from collections import Counter, defaultdict
+
+QUOTE_PATTERN = re.compile(r"<quote>([\s\S]*?)</quote>")
+# unverified debates written before the quote verifier renamed only the opening tag of the correct debater's quotes
+# and only the closing tag of the false debater's quotes, so the two tags are restored independently of each other
+UNVERIFIED_QUOTE_TAG_PATTERN = re.compile(r"<(/?)u_quote>")
+TAGGED_QUOTE_PATTERN = re.compile(r"<([vpu])_quote[ >]")
+LEADING_NON_WORD_PATTERN = re.compile(r"^\W+")
+TRAILING_NON_WORD_PATTERN = re.compile(r"\W+$")
+WORD_PATTERN = re.compile(r"\w+")
+
+DEFAULT_PARTIAL_MATCH_THRESHOLD = .8
+NGRAM_SIZE = 3
+# n-grams occurring more often than this are too unspecific to locate a quote
+MAX_NGRAM_OCCURRENCES = 32
+MAX_MATCH_CANDIDATES = 5
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def count_tagged_quotes(agent_response: str) -> dict[str, int]:
+    tag_counts = Counter(TAGGED_QUOTE_PATTERN.findall(agent_response))
+    return {
+        "num_verified_quotes": tag_counts["v"],
+        "num_partially_verified_quotes": tag_counts["p"],
+        "num_unverified_quotes": tag_counts["u"],
+    }
+
+
+def clean_quote(quote: str) -> str:
+    # debaters tend to wrap the quote in quotation marks inside the quote tags
+    cleaned_quote = LEADING_NON_WORD_PATTERN.sub("", quote)
+    return TRAILING_NON_WORD_PATTERN.sub("", cleaned_quote)
+
+
+def banded_edit_distance(quote_words: list[str], window_words: list[str], offset: int, band: int) -> int:
+    # word level edit distance of the quote to its best matching span in the window, only cells at most band words
+    # away from the expected alignment (quote word i at window word i + offset) are computed
+    infinity = len(quote_words) + len(window_words)
+    previous_row = [0] * (len(window_words) + 1)
+    for i in range(1, len(quote_words) + 1):
+        current_row = [infinity] * (len(window_words) + 1)
+        lowest_column = max(0, i + offset - band)
+        if lowest_column == 0:
+            current_row[0] = i
+        for j in range(max(1, lowest_column), min(len(window_words), i + offset + band) + 1):
+            current_row[j] = min(
+                previous_row[j - 1] + (quote_words[i - 1] != window_words[j - 1]),
+                previous_row[j] + 1,
+                current_row[j - 1] + 1,
+            )
+        previous_row = current_row
+    return min(previous_row)
+
+
+class NearMatchIndex:
+    def __init__(self, text: str):
+        self.words = WORD_PATTERN.findall(text.lower())
+        self.ngram_positions: dict[tuple[str, ...], list[int]] = defaultdict(list)
+        ngrams = zip(*(self.words[offset:] for offset in range(NGRAM_SIZE)))
+        for position, ngram in enumerate(ngrams):
+            self.ngram_positions[ngram].append(position)
+
+    def get_similarity(self, quote: str, threshold: float) -> float:
+        quote_words = WORD_PATTERN.findall(quote.lower())
+        if len(quote_words) < NGRAM_SIZE:
+            return 0.
+
+        # every shared n-gram votes for the story position the quote would start at
+        start_votes = Counter()
+        for quote_position in range(len(quote_words) - NGRAM_SIZE + 1):
+            story_positions = self.ngram_positions.get(tuple(quote_words[quote_position:quote_position + NGRAM_SIZE]))
+            if story_positions is None or len(story_positions) > MAX_NGRAM_OCCURRENCES:
+                continue
+            for story_position in story_positions:
+                start_votes[story_position - quote_position] += 1
+
+        band = max(1, int(len(quote_words) * (1 - threshold)))
+        best_similarity = 0.
+        for start, _ in start_votes.most_common(MAX_MATCH_CANDIDATES):
+            window_start = max(0, start - band)
+            window_words = self.words[window_start:start + len(quote_words) + band]
+            distance = banded_edit_distance(quote_words, window_words, start - window_start, band)
+            best_similarity = max(best_similarity, 1 - distance / len(quote_words))
+        return best_similarity
+
+
+class QuoteVerifier:
+    # quotes are matched literally against the normalized story, building a pure Python suffix index costs more than
+    # all substring searches of a debate together
+    def __init__(self, story: str, partial_match_threshold: float = DEFAULT_PARTIAL_MATCH_THRESHOLD):
+        self.story = story
+        self.normalized_story = normalize_text(story)
+        self.partial_match_threshold = partial_match_threshold
+        self.near_match_index: NearMatchIndex | None = None
+
+    def is_verified(self, quote: str) -> bool:
+        normalized_quote = normalize_text(quote)
+        return bool(normalized_quote) and normalized_quote in self.normalized_story
+
+    def get_partial_match_similarity(self, quote: str) -> float:
+        if self.near_match_index is None:
+            self.near_match_index = NearMatchIndex(self.story)
+        return self.near_match_index.get_similarity(quote, self.partial_match_threshold)
+
+    def verify_quotes(self, agent_response: str, use_partial_matches: bool = False) -> str:
+        return QUOTE_PATTERN.sub(lambda quote_match: self.tag_quote(quote_match, use_partial_matches), agent_response)
+
+    def tag_quote(self, quote_match: re.Match, use_partial_matches: bool = False) -> str:
+        cleaned_quote = clean_quote(quote_match.group(1))
+        if self.is_verified(cleaned_quote):
+            return f"<v_quote>{cleaned_quote}</v_quote>"
+
+        if use_partial_matches:
+            similarity = self.get_partial_match_similarity(cleaned_quote)
+            if similarity >= self.partial_match_threshold:
+                return f'<p_quote similarity="{similarity:.2f}">{cleaned_quote}</p_quote>'
+
+        return f"<u_quote>{cleaned_quote}</u_quote>"
+
+    @staticmethod
+    def mark_unverified(agent_response: str) -> str:
+        return QUOTE_PATTERN.sub(r"<u_quote>\1</u_quote>", agent_response)
+
+    @staticmethod
+    def unmark_unverified(agent_response: str) -> str:
+        # restores the quotes of a response that went through mark_unverified or its earlier, asymmetric version
+        return UNVERIFIED_QUOTE_TAG_PATTERN.sub(r"<\1quote>", agent_response)
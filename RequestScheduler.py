@@ -0,0 +1,199 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_REQUEST_TIMEOUT = 120.
+DEFAULT_BASE_BACKOFF = 1.
+DEFAULT_MAX_BACKOFF = 60.
+# tokens per minute limits count the requested completion tokens as well
+DEFAULT_COMPLETION_TOKEN_ESTIMATE = 400
+# providers enforce per minute limits over shorter windows, so only this many seconds worth of requests may burst
+DEFAULT_BURST_SECONDS = 1.
+
+CHARACTERS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+
+# USD per million (prompt, cached prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4o-mini": (.15, .075, .6),
+    "gpt-4o": (2.5, 1.25, 10.),
+}
+
+
+class SpendLimitExceeded(RuntimeError):
+    pass
+
+
+def estimate_prompt_tokens(messages: list[dict[str, str]]) -> int:
+    return sum(len(message["content"]) // CHARACTERS_PER_TOKEN + TOKENS_PER_MESSAGE for message in messages)
+
+
+def get_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    prompt_price, cached_prompt_price, completion_price = MODEL_PRICES[model]
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_prompt_price
+            + completion_tokens * completion_price) / 1_000_000
+
+
+def get_retry_after(error: Exception) -> float | None:
+    if not isinstance(error, APIStatusError):
+        return None
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After may also be an HTTP date, the backoff handles those
+        return None
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+class TokenBucket:
+    def __init__(self, capacity_per_minute: float, burst_seconds: float = DEFAULT_BURST_SECONDS):
+        self.refill_rate = capacity_per_minute / 60
+        self.capacity = max(1., self.refill_rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def get_wait_time(self, amount: float) -> float:
+        # requests larger than the bucket only wait for a full bucket instead of forever
+        self.refill()
+        missing_tokens = min(amount, self.capacity) - self.tokens
+        return max(0., missing_tokens / self.refill_rate)
+
+    def consume(self, amount: float):
+        # may go negative, e.g. when a response used more tokens than estimated
+        self.refill()
+        self.tokens -= amount
+
+
+class RequestScheduler:
+    # admits requests at the rate the provider allows instead of bursting into 429s, and retries transient errors
+    def __init__(self, requests_per_minute: float | None = None, tokens_per_minute: float | None = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES, request_timeout: float | None = DEFAULT_REQUEST_TIMEOUT,
+                 base_backoff: float = DEFAULT_BASE_BACKOFF, max_backoff: float = DEFAULT_MAX_BACKOFF,
+                 max_spend: float | None = None,
+                 completion_token_estimate: int = DEFAULT_COMPLETION_TOKEN_ESTIMATE,
+                 burst_seconds: float = DEFAULT_BURST_SECONDS):
+        self.request_bucket = None
+        if requests_per_minute is not None:
+            self.request_bucket = TokenBucket(requests_per_minute, burst_seconds)
+        self.token_bucket = None
+        if tokens_per_minute is not None:
+            self.token_bucket = TokenBucket(tokens_per_minute, burst_seconds)
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_spend = max_spend
+        self.completion_token_estimate = completion_token_estimate
+
+        # requests are admitted one after another, so that waiting requests are served in order
+        self.admission_lock = asyncio.Lock()
+        # after a rate limit error no request is admitted until the provider's Retry-After has passed
+        self.paused_until = 0.
+        self.spent = 0.
+        self.reserved_spend = 0.
+        self.retries = 0
+        self.rate_limit_errors = 0
+
+    async def acquire(self, estimated_tokens: int):
+        async with self.admission_lock:
+            while True:
+                wait_time = self.paused_until - time.monotonic()
+                if self.request_bucket is not None:
+                    wait_time = max(wait_time, self.request_bucket.get_wait_time(1))
+                if self.token_bucket is not None:
+                    wait_time = max(wait_time, self.token_bucket.get_wait_time(estimated_tokens))
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(estimated_tokens)
+
+    def reserve_spend(self, model: str, estimated_prompt_tokens: int) -> float:
+        if self.max_spend is None:
+            return 0.
+        if model not in MODEL_PRICES:
+            raise ValueError(f"No prices known for {model}, add them to MODEL_PRICES to use a spend ceiling")
+        estimated_cost = get_cost(model, estimated_prompt_tokens, 0, self.completion_token_estimate)
+        if self.spent + self.reserved_spend + estimated_cost > self.max_spend:
+            raise SpendLimitExceeded(f"Spend ceiling of ${self.max_spend:.2f} reached "
+                                     f"(${self.spent:.4f} spent, ${self.reserved_spend:.4f} in flight)")
+        self.reserved_spend += estimated_cost
+        return estimated_cost
+
+    def release_spend(self, reserved_cost: float):
+        self.reserved_spend -= reserved_cost
+
+    def record_spend(self, model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int):
+        if model in MODEL_PRICES:
+            self.spent += get_cost(model, prompt_tokens, cached_tokens, completion_tokens)
+
+    def record_usage(self, model: str, estimated_tokens: int, prompt_tokens: int, cached_tokens: int,
+                     completion_tokens: int):
+        if self.token_bucket is not None:
+            self.token_bucket.consume(prompt_tokens + completion_tokens - estimated_tokens)
+        self.record_spend(model, prompt_tokens, cached_tokens, completion_tokens)
+
+    def get_backoff(self, attempt: int, error: Exception) -> float:
+        # full jitter, but never earlier than the provider asked for
+        backoff = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        return backoff
+
+    async def run(self, model: str, messages: list[dict[str, str]], send_request: Callable[[], Awaitable]):
+        # send_request returns an LLMResponse, whose token counts correct the estimate of the rate limits and which
+        # gets the time spent waiting for admission and the number of retries
+        estimated_prompt_tokens = estimate_prompt_tokens(messages)
+        estimated_tokens = estimated_prompt_tokens + self.completion_token_estimate
+        reserved_cost = self.reserve_spend(model, estimated_prompt_tokens)
+
+        queue_time = 0.
+        try:
+            for attempt in range(self.max_retries + 1):
+                queue_start_time = time.perf_counter()
+                await self.acquire(estimated_tokens)
+                queue_time += time.perf_counter() - queue_start_time
+                try:
+                    response = await asyncio.wait_for(send_request(), self.request_timeout)
+                except Exception as e:
+                    if not is_retryable(e) or attempt == self.max_retries:
+                        raise
+
+                    backoff = self.get_backoff(attempt, e)
+                    if isinstance(e, RateLimitError):
+                        self.rate_limit_errors += 1
+                        self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+                    self.retries += 1
+                    await asyncio.sleep(backoff)
+                    continue
+
+                self.record_usage(model, estimated_tokens, response.prompt_tokens, response.cached_tokens,
+                                  response.completion_tokens)
+                response.queue_time = queue_time
+                response.retries = attempt
+                return response
+        finally:
+            self.release_spend(reserved_cost)
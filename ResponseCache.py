@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+RESPONSE_CACHE_FILE = "data/response_cache.sqlite"
+DEFAULT_MAX_CACHE_SIZE = 512 * 1024 * 1024
+CONNECTION_TIMEOUT = 60.
+
+
+class ResponseCache:
+    def __init__(self, path: str | os.PathLike[str] = RESPONSE_CACHE_FILE, max_size: int = DEFAULT_MAX_CACHE_SIZE,
+                 bypass: bool = False):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_size = max_size
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+        # the workers of a sharded run share the cache, a write waits for the others instead of failing
+        self.connection = sqlite3.connect(path, timeout=CONNECTION_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        # the total size is stored next to the responses, so that every worker updates it in its write transaction
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS cache_size (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            size INTEGER NOT NULL
+        )""")
+        self.connection.execute("INSERT OR IGNORE INTO cache_size (id, size) "
+                                "SELECT 0, COALESCE(SUM(size), 0) FROM responses")
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(model: str, messages: list[dict[str, str]], sampling_params: dict) -> str:
+        payload = json.dumps({
+            "model": model,
+            "messages": messages,
+            "sampling_params": sampling_params,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        if self.bypass:
+            return None
+
+        row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return row[0]
+
+    def put(self, key: str, response: str):
+        size = len(response.encode("utf-8"))
+        # take the write lock before reading the size, another worker can not change it until the commit
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            total_size = self.get_size()
+            previous_entry = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if previous_entry is not None:
+                total_size -= previous_entry[0]
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()))
+            total_size = self.evict(total_size + size)
+            self.connection.execute("UPDATE cache_size SET size = ? WHERE id = 0", (total_size,))
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+
+    def evict(self, total_size: int) -> int:
+        # drop least recently used responses until the cache fits into its size limit again
+        while total_size > self.max_size:
+            row = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            total_size -= row[1]
+        return total_size
+
+    def get_size(self) -> int:
+        return self.connection.execute("SELECT size FROM cache_size WHERE id = 0").fetchone()[0]
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": self.get_size(),
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,141 @@
+import os
+import re
+import time
+import uuid
+from collections import defaultdict
+
+import polars as pl
+
+from LLMAgent import LLMResponse
+from QuoteVerifier import count_tagged_quotes
+
+RESULTS_STORE_DIR = "data/results/"
+DEFAULT_FLUSH_SIZE = 1000
+
+RECORD_TYPE_ARGUMENT = "argument"
+RECORD_TYPE_JUDGEMENT = "judgement"
+JUDGE_AGENT_ID = "judge"
+
+JUDGE_VERDICT_PATTERN = re.compile(r"answer: (\w)", re.IGNORECASE)
+
+RESULTS_SCHEMA = {
+    "run_id": pl.String,
+    "question_id": pl.Int64,
+    "condition": pl.String,
+    "record_type": pl.String,
+    "round": pl.Int32,
+    "agent": pl.String,
+    "raw_response": pl.String,
+    "extracted_argument": pl.String,
+    "num_verified_quotes": pl.Int32,
+    "num_partially_verified_quotes": pl.Int32,
+    "num_unverified_quotes": pl.Int32,
+    "judge_ordering": pl.String,
+    "judge_verdict": pl.String,
+    "judge_sample": pl.Int32,
+    "judge_probability_a": pl.Float64,
+    "prompt_tokens": pl.Int64,
+    "completion_tokens": pl.Int64,
+    "cached_tokens": pl.Int64,
+    "latency": pl.Float64,
+    "time_to_first_token": pl.Float64,
+    "time_to_stop_pattern": pl.Float64,
+    "stopped_early": pl.Boolean,
+    "from_cache": pl.Boolean,
+    "created_at": pl.Float64,
+}
+# stored in the directory names (run_id=.../condition=.../), not in the files themselves
+PARTITION_COLUMNS = ("run_id", "condition")
+
+
+def get_run_id() -> str:
+    return time.strftime("%Y%m%dT%H%M%S")
+
+
+def get_judge_verdict(judge_response: str) -> str | None:
+    judge_verdict = JUDGE_VERDICT_PATTERN.search(judge_response)
+    return judge_verdict.group(1).upper() if judge_verdict else None
+
+
+def get_data_schema() -> dict[str, pl.DataType]:
+    return {column: dtype for column, dtype in RESULTS_SCHEMA.items() if column not in PARTITION_COLUMNS}
+
+
+def scan_results(store_dir: str = RESULTS_STORE_DIR) -> pl.LazyFrame:
+    # files written before a column was added to the schema read it as null
+    return pl.scan_parquet(os.path.join(store_dir, "**", "*.parquet"), hive_partitioning=True,
+                           schema=get_data_schema(), missing_columns="insert",
+                           hive_schema={column: RESULTS_SCHEMA[column] for column in PARTITION_COLUMNS})
+
+
+class ResultsStore:
+    # append only: records are buffered per condition and every flush adds a new parquet file to the partition.
+    # Debates flush a condition once they finished it, flush_size only bounds the buffer in between
+    def __init__(self, store_dir: str = RESULTS_STORE_DIR, run_id: str | None = None,
+                 flush_size: int = DEFAULT_FLUSH_SIZE):
+        self.store_dir = store_dir
+        self.run_id = run_id if run_id is not None else get_run_id()
+        self.flush_size = flush_size
+        self.buffers: dict[str, list[dict]] = defaultdict(list)
+
+    def add_argument(self, question_id: int, condition: str, debate_round: int, agent_id: str,
+                     llm_response: LLMResponse, verified_response: str, argument: str | None):
+        self.add_record(question_id, condition, llm_response, {
+            "record_type": RECORD_TYPE_ARGUMENT,
+            "round": debate_round,
+            "agent": agent_id,
+            "extracted_argument": argument,
+            **count_tagged_quotes(verified_response),
+        })
+
+    def add_judgement(self, question_id: int, condition: str, judge_ordering: str, llm_response: LLMResponse,
+                      judge_sample: int = 0, judge_probability_a: float | None = None):
+        self.add_record(question_id, condition, llm_response, {
+            "record_type": RECORD_TYPE_JUDGEMENT,
+            "agent": JUDGE_AGENT_ID,
+            "judge_ordering": judge_ordering,
+            "judge_verdict": get_judge_verdict(llm_response.content),
+            "judge_sample": judge_sample,
+            "judge_probability_a": judge_probability_a,
+        })
+
+    def add_record(self, question_id: int, condition: str, llm_response: LLMResponse, fields: dict):
+        buffer = self.buffers[condition]
+        buffer.append({
+            "question_id": question_id,
+            "raw_response": llm_response.content,
+            "prompt_tokens": llm_response.prompt_tokens,
+            "completion_tokens": llm_response.completion_tokens,
+            "cached_tokens": llm_response.cached_tokens,
+            "latency": llm_response.latency,
+            "time_to_first_token": llm_response.time_to_first_token,
+            "time_to_stop_pattern": llm_response.time_to_stop_pattern,
+            "stopped_early": llm_response.stopped_early,
+            "from_cache": llm_response.from_cache,
+            "created_at": time.time(),
+            **fields,
+        })
+        if len(buffer) >= self.flush_size:
+            self.flush_condition(condition)
+
+    def get_partition_dir(self, condition: str) -> str:
+        return os.path.join(self.store_dir, f"run_id={self.run_id}", f"condition={condition}")
+
+    def flush_condition(self, condition: str):
+        records = self.buffers.pop(condition, None)
+        if not records:
+            return
+
+        partition_dir = self.get_partition_dir(condition)
+        # workers of the same run write into the same partitions
+        os.makedirs(partition_dir, exist_ok=True)
+
+        results = pl.DataFrame(records, schema=get_data_schema())
+        results.write_parquet(os.path.join(partition_dir, f"part-{uuid.uuid4().hex}.parquet"))
+
+    def flush(self):
+        for condition in list(self.buffers):
+            self.flush_condition(condition)
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,36 @@
+import json
+import os
+
+TELEMETRY_DIR = "data/telemetry/"
+DEFAULT_FLUSH_SIZE = 100
+
+
+def get_telemetry_file_path(run_id: str, telemetry_dir: str = TELEMETRY_DIR) -> str:
+    return os.path.join(telemetry_dir, f"{run_id}.jsonl")
+
+
+class TelemetrySink:
+    # one JSON line per LLM call, appended in batches so that the file stays readable while the run is going
+    def __init__(self, file_path: str, flush_size: int = DEFAULT_FLUSH_SIZE):
+        self.file_path = file_path
+        self.flush_size = flush_size
+        self.records: list[dict] = []
+
+    def add_record(self, record: dict):
+        self.records.append(record)
+        if len(self.records) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+
+        directory = os.path.dirname(self.file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.file_path, 'a') as f:
+            f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in self.records))
+        self.records = []
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,112 @@
+from collections import defaultdict
+
+from LLMAgent import DEFAULT_MODEL
+from RequestScheduler import CHARACTERS_PER_TOKEN
+
+try:
+    import tiktoken
+except ImportError:
+    # without tiktoken, tokens are estimated from the number of characters like the request scheduler does
+    tiktoken = None
+
+DEFAULT_ENCODING = "o200k_base"
+STORY_TRUNCATION_MARKER = "\n[...]"
+ARGUMENT_TRUNCATION_MARKER = " [...]"
+TRANSCRIPT_TRUNCATION_MARKER = "[...]\n"
+SECTIONS = ("story", "transcript", "argument")
+
+
+def get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def cut_at_whitespace(text: str, keep_end: bool) -> str:
+    # the cut never splits a word, keep_end drops the partial first line instead of the partial last word
+    if keep_end:
+        line_start = text.find("\n")
+        return text[line_start + 1:] if 0 <= line_start < len(text) - 1 else text
+    word_end = max(text.rfind(" "), text.rfind("\n"))
+    return text[:word_end] if word_end > 0 else text
+
+
+class TokenBudget:
+    # token limits per prompt section, None leaves a section as it is. Truncation is deterministic: stories and
+    # arguments keep their beginning, transcripts keep their latest arguments
+    def __init__(self, model: str = DEFAULT_MODEL, max_story_tokens: int | None = None,
+                 max_transcript_tokens: int | None = None, max_argument_tokens: int | None = None):
+        self.encoding = get_encoding(model)
+        self.max_tokens = {
+            "story": max_story_tokens,
+            "transcript": max_transcript_tokens,
+            "argument": max_argument_tokens,
+        }
+        if any(max_tokens is not None and max_tokens < 1 for max_tokens in self.max_tokens.values()):
+            raise ValueError("A token budget needs at least one token per section")
+        # every debater prompt contains the story, so it is only counted, truncated and recorded once
+        self.truncated_stories: dict[str, str] = {}
+        # section -> token counts after truncation, one per rendered transcript or argument and one per story
+        self.section_sizes: dict[str, list[int]] = defaultdict(list)
+        self.truncations: dict[str, int] = defaultdict(int)
+
+    def encode(self, text: str) -> list[int]:
+        return self.encoding.encode(text, disallowed_special=())
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            return len(text) // CHARACTERS_PER_TOKEN
+        return len(self.encode(text))
+
+    def cut(self, text: str, max_tokens: int, keep_end: bool) -> str:
+        if self.encoding is None:
+            max_characters = max_tokens * CHARACTERS_PER_TOKEN
+            text = text[-max_characters:] if keep_end else text[:max_characters]
+        else:
+            tokens = self.encode(text)
+            tokens = tokens[-max_tokens:] if keep_end else tokens[:max_tokens]
+            # a cut can split a multi-byte character between two tokens
+            text = self.encoding.decode_bytes(tokens).decode("utf-8", errors="ignore")
+        return cut_at_whitespace(text, keep_end)
+
+    def truncate(self, section: str, text: str) -> str:
+        num_tokens = self.count_tokens(text)
+        max_tokens = self.max_tokens[section]
+        if max_tokens is None or num_tokens <= max_tokens:
+            self.section_sizes[section].append(num_tokens)
+            return text
+
+        self.truncations[section] += 1
+        if section == "transcript":
+            truncated_text = TRANSCRIPT_TRUNCATION_MARKER + self.cut(text, max_tokens, keep_end=True)
+        elif section == "story":
+            truncated_text = self.cut(text, max_tokens, keep_end=False) + STORY_TRUNCATION_MARKER
+        else:
+            truncated_text = self.cut(text, max_tokens, keep_end=False) + ARGUMENT_TRUNCATION_MARKER
+        self.section_sizes[section].append(self.count_tokens(truncated_text))
+        return truncated_text
+
+    def truncate_story(self, story: str) -> str:
+        if story not in self.truncated_stories:
+            self.truncated_stories[story] = self.truncate("story", story)
+        return self.truncated_stories[story]
+
+    def truncate_transcript(self, transcript: str) -> str:
+        return self.truncate("transcript", transcript)
+
+    def truncate_argument(self, argument: str) -> str:
+        return self.truncate("argument", argument)
+
+    def get_summary(self) -> dict[str, dict[str, int | float]]:
+        return {
+            section: {
+                "sections": len(self.section_sizes[section]),
+                "mean_tokens": sum(self.section_sizes[section]) / len(self.section_sizes[section]),
+                "max_tokens": max(self.section_sizes[section]),
+                "truncated": self.truncations[section],
+            }
+            for section in SECTIONS if self.section_sizes[section]
+        }
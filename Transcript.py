@@ -0,0 +1,100 @@
+import re
+from typing import Callable
+
+ARGUMENT_PATTERN = re.compile(r"<argument>([\s\S]*?)</argument>")
+# nothing after the argument is shown to anyone, so streamed debater responses can stop here
+ARGUMENT_END_PATTERN = re.compile(r"</argument>")
+
+
+def extract_argument(agent_message: str) -> tuple[str, str | None]:
+    extracted_argument = ARGUMENT_PATTERN.search(agent_message)
+    if not extracted_argument:
+        if "<argument>" not in agent_message:
+            return agent_message, None
+        # the model stopped before closing the argument tag
+        agent_message += "</argument>"
+        extracted_argument = ARGUMENT_PATTERN.search(agent_message)
+    return agent_message, extracted_argument.group(1).strip()
+
+
+class Transcript:
+    def __init__(self, agent_ids: tuple[str, ...] = ("correct_agent", "false_agent")):
+        self.agent_ids = agent_ids
+        self.messages: dict[str, list[str]] = {agent_id: [] for agent_id in agent_ids}
+        self.arguments: dict[str, list[str | None]] = {agent_id: [] for agent_id in agent_ids}
+        # rendered rounds per view, so that every round is only rendered once per view
+        self.rendered_rounds: dict[tuple, list[str]] = {}
+
+    @classmethod
+    def from_message_history(cls, message_history: dict[str, list[str]]) -> "Transcript":
+        transcript = cls(tuple(message_history.keys()))
+        for agent_id, agent_messages in message_history.items():
+            for agent_message in agent_messages:
+                transcript.append(agent_id, agent_message)
+        return transcript
+
+    def to_message_history(self) -> dict[str, list[str]]:
+        return self.messages
+
+    @property
+    def num_rounds(self) -> int:
+        return min(len(agent_messages) for agent_messages in self.messages.values())
+
+    def append(self, agent_id: str, agent_message: str):
+        agent_message, argument = extract_argument(agent_message)
+        self.messages[agent_id].append(agent_message)
+        self.arguments[agent_id].append(argument)
+
+    def get_argument(self, agent_id: str, debate_round: int) -> str:
+        argument = self.arguments[agent_id][debate_round]
+        if argument is None:
+            raise ValueError("Argument not found in agent message: " + self.messages[agent_id][debate_round])
+        return argument
+
+    def render(self, view_key: tuple, agent_order: tuple[str, ...], render_round,
+               include_current_round: bool = True) -> str:
+        rendered_rounds = self.rendered_rounds.setdefault(view_key, [])
+        for debate_round in range(len(rendered_rounds), self.num_rounds):
+            rendered_rounds.append(render_round(debate_round, agent_order))
+
+        # in sequential debates some debaters have already argued in the current round
+        agents_in_current_round = tuple(agent_id for agent_id in agent_order
+                                        if len(self.arguments[agent_id]) > self.num_rounds)
+        if include_current_round and agents_in_current_round:
+            return "\n".join(rendered_rounds + [render_round(self.num_rounds, agents_in_current_round)]).rstrip()
+        return "\n".join(rendered_rounds).rstrip()
+
+    def get_rendered_argument(self, agent_id: str, debate_round: int,
+                              format_argument: Callable[[str], str] | None = None) -> str:
+        argument = self.get_argument(agent_id, debate_round)
+        return argument if format_argument is None else format_argument(argument)
+
+    def render_debater_view(self, agent_order: tuple[str, ...], teammate_ids: tuple[str, ...] = (),
+                            format_argument: Callable[[str], str] | None = None,
+                            include_current_round: bool = False) -> str:
+        # the first agent is the one the transcript is shown to. Only sequential debates show the arguments of the
+        # current round, in a resumed simultaneous round the waiting debaters must not see their opponents' answers
+        def render_round(debate_round: int, agent_ids: tuple[str, ...]) -> str:
+            lines = []
+            for agent_id in agent_ids:
+                if agent_id == agent_order[0]:
+                    tag = "your_argument"
+                elif agent_id in teammate_ids:
+                    tag = "teammate_argument"
+                else:
+                    tag = "opponent_argument"
+                lines.append(f"<{tag}>{self.get_rendered_argument(agent_id, debate_round, format_argument)}</{tag}>")
+            return "\n".join(lines)
+
+        return self.render(("debater", agent_order, teammate_ids, format_argument), agent_order, render_round,
+                           include_current_round)
+
+    def render_judge_view(self, agent_order: tuple[str, ...], debater_names: tuple[str, ...],
+                          format_argument: Callable[[str], str] | None = None) -> str:
+        names = dict(zip(agent_order, debater_names))
+
+        def render_round(debate_round: int, agent_ids: tuple[str, ...]) -> str:
+            return "\n".join(f"{names[agent_id]}: {self.get_rendered_argument(agent_id, debate_round, format_argument)}"
+                             for agent_id in agent_ids)
+
+        return self.render(("judge", agent_order, debater_names, format_argument), agent_order, render_round)
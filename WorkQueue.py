@@ -0,0 +1,93 @@
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+WORK_QUEUE_FILE = "data/work_queue.sqlite"
+# a claim older than this is taken over by another worker, the worker that made it has probably crashed
+DEFAULT_LEASE_TIME = 3600.
+# questions whose experiment failed this often are not claimed again
+DEFAULT_MAX_ATTEMPTS = 3
+LOCK_TIMEOUT = 60.
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    # question ids shared by all workers of a run through one SQLite file, every question is claimed by one worker
+    # at a time. The file needs a file system with working locks, workers on several machines can use --shard instead
+    def __init__(self, path: str | os.PathLike[str] = WORK_QUEUE_FILE, queue_name: str = "default",
+                 lease_time: float = DEFAULT_LEASE_TIME, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.queue_name = queue_name
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        # autocommit, statements that belong together run in an explicit transaction
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS questions (
+            queue TEXT NOT NULL,
+            question_id INTEGER NOT NULL,
+            worker_id TEXT,
+            claimed_at REAL,
+            finished_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (queue, question_id)
+        )""")
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock right away, so that no two workers read the same free question
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def add(self, question_ids: Iterable[int]):
+        # every worker adds the same questions, the ones already in the queue keep their state
+        with self.transaction() as connection:
+            connection.executemany("INSERT OR IGNORE INTO questions (queue, question_id) VALUES (?, ?)",
+                                   [(self.queue_name, question_id) for question_id in question_ids])
+
+    def claim(self, worker_id: str) -> int | None:
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT question_id FROM questions WHERE queue = ? AND finished_at IS NULL AND attempts < ? "
+                "AND (claimed_at IS NULL OR claimed_at < ?) ORDER BY question_id LIMIT 1",
+                (self.queue_name, self.max_attempts, now - self.lease_time)).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE questions SET worker_id = ?, claimed_at = ?, attempts = attempts + 1 "
+                    "WHERE queue = ? AND question_id = ?", (worker_id, now, self.queue_name, row[0]))
+        return row[0] if row is not None else None
+
+    def finish(self, question_id: int):
+        self.connection.execute("UPDATE questions SET finished_at = ? WHERE queue = ? AND question_id = ?",
+                                (time.time(), self.queue_name, question_id))
+
+    def release(self, question_id: int):
+        # the question can be claimed again right away, until it has failed max_attempts times
+        self.connection.execute("UPDATE questions SET worker_id = NULL, claimed_at = NULL "
+                                "WHERE queue = ? AND question_id = ?", (self.queue_name, question_id))
+
+    def get_counts(self) -> dict[str, int]:
+        finished, claimed, failed, pending = self.connection.execute(
+            "SELECT COUNT(finished_at), "
+            "COALESCE(SUM(finished_at IS NULL AND claimed_at IS NOT NULL), 0), "
+            "COALESCE(SUM(finished_at IS NULL AND claimed_at IS NULL AND attempts >= ?), 0), "
+            "COALESCE(SUM(finished_at IS NULL AND claimed_at IS NULL AND attempts < ?), 0) "
+            "FROM questions WHERE queue = ?", (self.max_attempts, self.max_attempts, self.queue_name)).fetchone()
+        return {"finished": finished, "claimed": claimed, "failed": failed, "pending": pending}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,61 @@
+# run from the repository root as python -m benchmarks.dataset_loading, so that the modules of the repository are
+# importable
+import os
+import shutil
+import tempfile
+import time
+
+import polars as pl
+
+from load_data import DATASET_FILES, LEGACY_ARTICLE_DATA_FILE, LEGACY_QUESTION_DATA_FILE, PARSED_DATA_DIR, Dataset
+
+REPEATS = 5
+
+
+def time_startup(parsed_data_dir: str, clear_cache: bool) -> float:
+    best_time = float("inf")
+    for _ in range(REPEATS):
+        if clear_cache:
+            shutil.rmtree(parsed_data_dir, ignore_errors=True)
+        start = time.perf_counter()
+        dataset = Dataset(parsed_data_dir=parsed_data_dir)
+        # the first question forces one story out of the memory mapped file
+        dataset[0]
+        best_time = min(best_time, time.perf_counter() - start)
+    return best_time
+
+
+def time_csv_startup() -> float:
+    # the previous cache, which parsed both CSV files on every startup
+    best_time = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        pl.read_csv(os.path.join(PARSED_DATA_DIR, LEGACY_ARTICLE_DATA_FILE))
+        pl.read_csv(os.path.join(PARSED_DATA_DIR, LEGACY_QUESTION_DATA_FILE))
+        best_time = min(best_time, time.perf_counter() - start)
+    return best_time
+
+
+if __name__ == '__main__':
+    has_sources = all(os.path.isfile(dataset_path) for dataset_path in DATASET_FILES.values())
+    has_csv_cache = all(os.path.isfile(os.path.join(PARSED_DATA_DIR, file_name))
+                        for file_name in (LEGACY_ARTICLE_DATA_FILE, LEGACY_QUESTION_DATA_FILE))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        parsed_data_dir = os.path.join(temp_dir, "parsed_data")
+        if has_sources:
+            print(f"cold start from the QuALITY sources: {time_startup(parsed_data_dir, True) * 1000:.1f} ms")
+        elif has_csv_cache:
+            shutil.copytree(PARSED_DATA_DIR, parsed_data_dir)
+            for file_name in os.listdir(parsed_data_dir):
+                if not file_name.endswith(".csv"):
+                    os.remove(os.path.join(parsed_data_dir, file_name))
+            start = time.perf_counter()
+            Dataset(parsed_data_dir=parsed_data_dir)
+            print(f"cold start from the CSV cache: {(time.perf_counter() - start) * 1000:.1f} ms")
+        else:
+            raise FileNotFoundError(f"Neither the QuALITY source files nor a CSV cache in {PARSED_DATA_DIR} exist")
+
+        if has_csv_cache:
+            print(f"warm start with the CSV cache: {time_csv_startup() * 1000:.1f} ms")
+        print(f"warm start with the arrow cache: {time_startup(parsed_data_dir, False) * 1000:.1f} ms")
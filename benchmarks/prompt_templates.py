@@ -0,0 +1,85 @@
+# run from the repository root as python -m benchmarks.prompt_templates, so that the modules of the repository are
+# importable
+import re
+import timeit
+
+import polars as pl
+
+from Debate import Debate, DEBATER_THINKING_ADVICE, JUDGE_PROMPT, NEW_ARGUMENT_REQUEST, START_DEBATE_USER_PROMPT, \
+    DEBATER_NAME_A, DEBATER_NAME_B
+from LLMAgent import LLMAgent
+from ModelBackend import SyntheticBackend
+from load_data import Dataset
+
+NUM_STORIES = 10
+NUM_REPETITIONS = 200
+ARGUMENT = "<thinking>...</thinking> <argument>" + "This is a fairly long argument. " * 30 + "</argument>"
+
+
+def prepare_debate_user_prompt_with_re_sub(debate: Debate, debate_round: int) -> str:
+    prepared_debate_user_prompt = re.sub(r"\[STORY]", debate.story, START_DEBATE_USER_PROMPT)
+    prepared_debate_user_prompt = re.sub(r"\[TRANSCRIPT]", debate.prepare_transcript_prompt("correct_agent"),
+                                         prepared_debate_user_prompt)
+    new_argument_request = re.sub(r"\[QUESTION]", debate.question, NEW_ARGUMENT_REQUEST[min(debate_round, 1)])
+    new_argument_request = re.sub(r"\[ANSWER_DEFENDING]", debate.correct_answer, new_argument_request)
+    prepared_debate_user_prompt = re.sub(r"\[NEW_ARGUMENT_REQUEST]", new_argument_request,
+                                         prepared_debate_user_prompt)
+    return re.sub(r"\[THINKING_ADVICE]", DEBATER_THINKING_ADVICE[min(debate_round, 2)], prepared_debate_user_prompt)
+
+
+def get_judge_prompt_with_re_sub(debate: Debate) -> str:
+    judge_prompt = re.sub(r"\[QUESTION]", debate.question, JUDGE_PROMPT)
+    judge_prompt = re.sub(r"\[ANSWER_A]", debate.correct_answer, judge_prompt)
+    judge_prompt = re.sub(r"\[ANSWER_B]", debate.false_answer, judge_prompt)
+    judge_prompt = re.sub(r"\[NAME_A]", DEBATER_NAME_A, judge_prompt)
+    judge_prompt = re.sub(r"\[NAME_B]", DEBATER_NAME_B, judge_prompt)
+    judge_prompt = re.sub(r"\[PARTIAL_QUOTE_JUDGE_PROMPT]", "", judge_prompt)
+    return re.sub(r"\[TRANSCRIPT]", debate.prepare_transcript_for_judge(True), judge_prompt)
+
+
+if __name__ == '__main__':
+    dataset = Dataset()
+    # the benchmark never sends a request, the synthetic backend avoids creating an API client
+    agent = LLMAgent(backend=SyntheticBackend())
+    longest_articles = dataset.article_data.sort(pl.col("article").str.len_chars(), descending=True).head(NUM_STORIES)
+
+    debates = []
+    for article in longest_articles["article"]:
+        debate = Debate(question_id=0, story=article, question="Which question is this?", correct_answer="This one",
+                        false_answer="Another one", agent=agent)
+        debate.agent_message_history = {
+            "correct_agent": [ARGUMENT, ARGUMENT],
+            "false_agent": [ARGUMENT, ARGUMENT],
+        }
+        debates.append(debate)
+
+    print(f"Rendering prompts for the {NUM_STORIES} longest stories "
+          f"({min(map(len, longest_articles['article']))}-{max(map(len, longest_articles['article']))} characters)")
+    for name, re_sub_builder, template_builder in [
+        ("debater prompt", lambda d: prepare_debate_user_prompt_with_re_sub(d, 2),
+         lambda d: d.prepare_debate_user_prompt(d.story, d.question, d.correct_answer, "correct_agent", 2)),
+        ("judge prompt", get_judge_prompt_with_re_sub, lambda d: d.get_judge_prompt(True)),
+    ]:
+        # re.sub reads backslashes in the stories as escapes, so it fails on some stories and alters others
+        re_sub_debates = []
+        re_errors = 0
+        disagreements = 0
+        for debate in debates:
+            try:
+                re_sub_prompt = re_sub_builder(debate)
+            except re.error:
+                re_errors += 1
+                continue
+            disagreements += re_sub_prompt != template_builder(debate)
+            re_sub_debates.append(debate)
+        print(f"{name}: {re_errors} stories raised re.error, {disagreements} prompts rendered differently by re.sub")
+        if not re_sub_debates:
+            continue
+
+        re_sub_time = timeit.timeit(lambda: [re_sub_builder(debate) for debate in re_sub_debates],
+                                    number=NUM_REPETITIONS)
+        template_time = timeit.timeit(lambda: [template_builder(debate) for debate in re_sub_debates],
+                                      number=NUM_REPETITIONS)
+        calls = NUM_REPETITIONS * len(re_sub_debates)
+        print(f"{name}: re.sub {re_sub_time / calls * 1e6:.1f} µs, template {template_time / calls * 1e6:.1f} µs "
+              f"per prompt ({re_sub_time / template_time:.1f}x)")
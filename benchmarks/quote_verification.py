@@ -0,0 +1,85 @@
+# run from the repository root as python -m benchmarks.quote_verification, so that the modules of the repository are
+# importable
+import random
+import re
+import time
+
+from QuoteVerifier import QuoteVerifier
+from load_data import Dataset
+
+QUOTES_PER_RESPONSE = 4
+# one response per debater and round
+RESPONSES_PER_STORY = 6
+RANDOM_SEED = 0
+
+
+def verify_quotes_with_re(story_lower_case: str, agent_response: str) -> str:
+    for quote in re.findall(r"<quote>([\s\S]*?)</quote>", agent_response):
+        cleaned_quote = re.sub(r"^\W+", "", quote)
+        cleaned_quote = re.sub(r"\W+$", "", cleaned_quote)
+        if cleaned_quote and re.search(cleaned_quote.lower(), story_lower_case):
+            agent_response = re.sub(f"<quote>{quote}</quote>", f"<v_quote>{cleaned_quote}</v_quote>",
+                                    agent_response)
+        else:
+            agent_response = re.sub(f"<quote>{quote}</quote>", f"<u_quote>{cleaned_quote}</u_quote>",
+                                    agent_response)
+    return agent_response
+
+
+def sample_response(story: str, rng: random.Random) -> str:
+    story_words = story.split(" ")
+    response = "<argument>"
+    for _ in range(QUOTES_PER_RESPONSE):
+        start = rng.randrange(max(1, len(story_words) - 30))
+        quote_words = story_words[start:start + rng.randint(5, 30)]
+        if rng.random() < .3:
+            # paraphrased quote
+            quote_words[rng.randrange(len(quote_words))] = "something"
+        response += f'Some argument text. <quote>"{" ".join(quote_words)}"</quote> '
+    return response + "</argument>"
+
+
+if __name__ == '__main__':
+    rng = random.Random(RANDOM_SEED)
+    dataset = Dataset()
+    samples = [(article, [sample_response(article, rng) for _ in range(RESPONSES_PER_STORY)])
+               for article, *_ in dataset]
+
+    re_time = 0.
+    re_errors = 0
+    re_results = []
+    for article, responses in samples:
+        start = time.perf_counter()
+        story_lower_case = article.lower()
+        for response in responses:
+            try:
+                re_results.append(verify_quotes_with_re(story_lower_case, response))
+            except re.error:
+                re_errors += 1
+                re_results.append(None)
+        re_time += time.perf_counter() - start
+
+    verifier_results = []
+    start = time.perf_counter()
+    for article, responses in samples:
+        quote_verifier = QuoteVerifier(article)
+        verifier_results.extend(quote_verifier.verify_quotes(response) for response in responses)
+    verifier_time = time.perf_counter() - start
+
+    partial_results = []
+    start = time.perf_counter()
+    for article, responses in samples:
+        quote_verifier = QuoteVerifier(article)
+        partial_results.extend(quote_verifier.verify_quotes(response, use_partial_matches=True)
+                               for response in responses)
+    partial_time = time.perf_counter() - start
+
+    disagreements = sum(re_result is not None and re_result != verifier_result
+                        for re_result, verifier_result in zip(re_results, verifier_results))
+    print(f"{len(samples)} stories with {RESPONSES_PER_STORY} responses of {QUOTES_PER_RESPONSE} quotes each")
+    print(f"re: {re_time:.3f} s ({re_errors} responses raised re.error)")
+    print(f"QuoteVerifier: {verifier_time:.3f} s ({re_time / verifier_time:.1f}x)")
+    print(f"QuoteVerifier with partial matches: {partial_time:.3f} s, "
+          f"{sum(result.count('<p_quote') for result in partial_results)} partially verified quotes, "
+          f"{sum(result.count('<u_quote') for result in partial_results)} unverified quotes")
+    print(f"{disagreements} responses verified differently, e.g. quotes with regex metacharacters")
@@ -0,0 +1,115 @@
+# run from the repository root as python -m benchmarks.rate_limits, so that the modules of the repository are
+# importable
+import asyncio
+import json
+import time
+
+import httpx
+from openai import AsyncOpenAI
+
+from LLMAgent import LLMAgent
+from RequestScheduler import RequestScheduler, estimate_prompt_tokens
+
+# limits of the fake provider, scaled down so that a run takes seconds instead of minutes
+REQUESTS_PER_MINUTE = 1200
+TOKENS_PER_MINUTE = 600_000
+# seconds worth of the limits the fake provider allows in a burst
+PROVIDER_BURST_SECONDS = 1.
+# the scheduler is configured slightly below the limits, as recommended for the real provider
+SCHEDULER_HEADROOM = .95
+RESPONSE_LATENCY = .05
+COMPLETION_TOKENS = 150
+NUM_REQUESTS = 300
+CONCURRENCY = 64
+
+
+class FakeProvider:
+    # in process chat completions endpoint that answers 429 with Retry-After once a per minute limit is exceeded
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.capacities = {limit_name: limit / 60 * PROVIDER_BURST_SECONDS for limit_name, limit in self.limits.items()}
+        self.remaining = dict(self.capacities)
+        self.updated_at = time.monotonic()
+        self.completed = 0
+        self.rate_limited = 0
+
+    def refill(self):
+        now = time.monotonic()
+        for limit_name, limit in self.limits.items():
+            self.remaining[limit_name] = min(self.capacities[limit_name],
+                                             self.remaining[limit_name] + (now - self.updated_at) * limit / 60)
+        self.updated_at = now
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        prompt_tokens = estimate_prompt_tokens(body["messages"])
+        self.refill()
+        if self.remaining["requests"] < 1 or self.remaining["tokens"] < prompt_tokens + COMPLETION_TOKENS:
+            self.rate_limited += 1
+            missing_tokens = prompt_tokens + COMPLETION_TOKENS - self.remaining["tokens"]
+            retry_after = max(60 / self.limits["requests"], missing_tokens * 60 / self.limits["tokens"])
+            return httpx.Response(429, headers={"retry-after-ms": str(int(retry_after * 1000))},
+                                  json={"error": {"message": "Rate limit reached", "type": "requests"}})
+
+        self.remaining["requests"] -= 1
+        self.remaining["tokens"] -= prompt_tokens + COMPLETION_TOKENS
+        await asyncio.sleep(RESPONSE_LATENCY)
+        self.completed += 1
+        return httpx.Response(200, json={
+            "id": f"chatcmpl-{self.completed}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "<thinking></thinking> <argument></argument>"},
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": COMPLETION_TOKENS,
+                "total_tokens": prompt_tokens + COMPLETION_TOKENS,
+            },
+        })
+
+
+async def run_requests(scheduler: RequestScheduler | None) -> dict[str, float]:
+    provider = FakeProvider(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    client = AsyncOpenAI(api_key="fake", base_url="http://fake-provider/v1",
+                         http_client=httpx.AsyncClient(transport=httpx.MockTransport(provider.handle)))
+    agent = LLMAgent(client=client, scheduler=scheduler)
+    messages = [{"role": "user", "content": "Which debater is right? " * 40}]
+    concurrency_limit = asyncio.Semaphore(CONCURRENCY)
+
+    async def run_request() -> bool:
+        async with concurrency_limit:
+            try:
+                await agent.get_response(messages)
+            except Exception:
+                return False
+            return True
+
+    start_time = time.perf_counter()
+    succeeded = sum(await asyncio.gather(*[run_request() for _ in range(NUM_REQUESTS)]))
+    elapsed_time = time.perf_counter() - start_time
+    await client.close()
+    return {
+        "succeeded": succeeded,
+        "failed": NUM_REQUESTS - succeeded,
+        "rate_limited": provider.rate_limited,
+        "requests_per_minute": succeeded / elapsed_time * 60,
+    }
+
+
+if __name__ == '__main__':
+    print(f"Fake provider: {REQUESTS_PER_MINUTE} requests and {TOKENS_PER_MINUTE} tokens per minute, "
+          f"{NUM_REQUESTS} requests with concurrency {CONCURRENCY}")
+    for name, scheduler in (
+            ("client retries only", None),
+            ("scheduler", RequestScheduler(requests_per_minute=REQUESTS_PER_MINUTE * SCHEDULER_HEADROOM,
+                                           tokens_per_minute=TOKENS_PER_MINUTE * SCHEDULER_HEADROOM,
+                                           completion_token_estimate=COMPLETION_TOKENS)),
+    ):
+        results = asyncio.run(run_requests(scheduler))
+        print(f"{name}: {results['succeeded']} succeeded, {results['failed']} failed, "
+              f"{results['rate_limited']} rate limited responses, {results['requests_per_minute']:.0f} requests/min")
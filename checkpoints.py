@@ -0,0 +1,45 @@
+import asyncio
+import json
+import os
+import tempfile
+
+
+def write_json_atomically(file_path: str, content):
+    # readers either see the previous or the new file, never a partially written one
+    directory = os.path.dirname(file_path) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    file_descriptor, temp_file_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'w') as f:
+            f.write(json.dumps(content, ensure_ascii=False))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+
+
+def read_json(file_path: str):
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def remove_file(file_path: str):
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+
+
+async def gather_all(*awaitables) -> list:
+    # unlike asyncio.gather, waits for all awaitables before raising the first exception, so that calls already in
+    # flight still get checkpointed
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
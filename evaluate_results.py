@@ -1,140 +1,196 @@
-import json
+import argparse
 import os
-import re
 
 import polars as pl
 import seaborn as sns
 from matplotlib import pyplot as plt
 
-from Debate import JUDGE_RESULTS_DIR
-
-
-def parse_result(judge_response: str, correct_answer_first: bool) -> int:
-    judge_answer = re.search(r"answer: (\w)", judge_response.lower())
-    if not judge_answer:
-        raise RuntimeError("Could not find answer in judge response: " + judge_response)
-    judge_answer = judge_answer.group(1).strip()
-    if correct_answer_first:
-        if judge_answer == "a":
-            return 1
-        else:
-            return 0
-    else:
-        if judge_answer == "a":
-            return 0
-        else:
-            return 1
-
-
-def get_file_results(files: list[str]) -> list[dict[str, int]]:
-    judge_results = []
+from Debate import JUDGE_ORDERINGS, JUDGE_RESULTS_DIR, LOGPROB_JUDGE_RESULTS_DIR
+from ResultsStore import JUDGE_VERDICT_PATTERN, RECORD_TYPE_JUDGEMENT, RESULTS_STORE_DIR, scan_results
+from judge_sampling import get_majority_probability
+
+JUDGE_RESULT_FILE_PATTERN = r"^([a-z_]+)_(\d+)\.json$"
+VERIFIED_CONDITION = "verified"
+UNVERIFIED_CONDITION = "unverified"
+
+
+def read_judge_result_files(judge_results_dir: str = JUDGE_RESULTS_DIR) -> pl.LazyFrame:
+    # every judge result file is a single line JSON object, joined they form one NDJSON document that polars parses at
+    # once, which is much faster than scanning thousands of small files
+    file_names = sorted(file_name for file_name in os.listdir(judge_results_dir) if file_name.endswith(".json"))
+    if not file_names:
+        raise FileNotFoundError(f"No judge results found in {judge_results_dir}")
+    file_contents = []
+    for file_name in file_names:
+        with open(os.path.join(judge_results_dir, file_name), 'rb') as f:
+            file_contents.append(f.read().strip())
+
+    judge_results = pl.read_ndjson(b"\n".join(file_contents), schema={
+        **{judge_ordering: pl.String for judge_ordering in JUDGE_ORDERINGS},
+        "samples": pl.Struct({judge_ordering: pl.List(pl.String) for judge_ordering in JUDGE_ORDERINGS}),
+        "probabilities": pl.Struct({judge_ordering: pl.Float64 for judge_ordering in JUDGE_ORDERINGS}),
+    })
+    return judge_results.with_columns(file_name=pl.Series(file_names)).lazy().select(
+        pl.col("file_name").str.extract(JUDGE_RESULT_FILE_PATTERN, 1).alias("condition"),
+        pl.col("file_name").str.extract(JUDGE_RESULT_FILE_PATTERN, 2).cast(pl.Int64).alias("question_id"),
+        # only files with more than one judge sample per ordering have the samples field and only files of the
+        # logprobs judge have the probabilities field
+        *[pl.struct(
+            raw_response=pl.coalesce(pl.col("samples").struct.field(judge_ordering), pl.concat_list(judge_ordering)),
+            judge_probability_a=pl.col("probabilities").struct.field(judge_ordering),
+        ).alias(judge_ordering) for judge_ordering in JUDGE_ORDERINGS],
+    ).unpivot(
+        index=["condition", "question_id"], variable_name="judge_ordering", value_name="judge_result",
+    ).unnest("judge_result").with_columns(
+        judge_sample=pl.int_ranges(pl.col("raw_response").list.len(), dtype=pl.Int32),
+    ).explode("raw_response", "judge_sample")
+
+
+def scan_judge_results_store(store_dir: str = RESULTS_STORE_DIR, run_id: str | None = None) -> pl.LazyFrame:
+    judgements = scan_results(store_dir).filter(pl.col("record_type") == RECORD_TYPE_JUDGEMENT)
+    if run_id is not None:
+        judgements = judgements.filter(pl.col("run_id") == run_id)
+    # a resumed run can store a judgement more than once, the latest one counts. Judgements stored before the judge
+    # was sampled repeatedly have no sample index, they are the only sample
+    return judgements.with_columns(pl.col("judge_sample").fill_null(0)).sort("created_at").unique(
+        ["condition", "question_id", "judge_ordering", "judge_sample"], keep="last",
+    ).select(
+        "condition", "question_id", "judge_ordering", "judge_sample", "raw_response", "judge_probability_a",
+    )
 
-    for file_name in files:
-        with open(file_name) as f:
-            question_id = int(re.search(r"_(\d+).json", file_name).group(1))
-            file_contents = json.load(f)
-            judge_results.append({
-                "question_id": question_id,
-                "is_correct_first": 1,
-                "is_judge_correct": parse_result(file_contents["correct_first"], True)
-            })
-            judge_results.append({
-                "question_id": question_id,
-                "is_correct_first": 0,
-                "is_judge_correct": parse_result(file_contents["correct_second"], False)
-            })
 
-    return judge_results
+def get_num_samples(judge_responses: pl.LazyFrame) -> int:
+    # the most verdicts sampled for one judge ordering
+    max_judge_sample = judge_responses.select(pl.col("judge_sample").max()).collect().item()
+    return max_judge_sample + 1 if max_judge_sample is not None else 1
+
+
+def get_majority_probabilities(max_samples: int) -> pl.LazyFrame:
+    # the confidence of every possible vote count, so that the judgements only need a join
+    vote_counts = [(votes_a, votes_b) for votes_a in range(max_samples + 1)
+                   for votes_b in range(max_samples + 1 - votes_a)]
+    return pl.LazyFrame({
+        "votes_a": [votes_a for votes_a, _ in vote_counts],
+        "votes_b": [votes_b for _, votes_b in vote_counts],
+        "majority_probability": [get_majority_probability(votes_a, votes_b) for votes_a, votes_b in vote_counts],
+    }, schema={"votes_a": pl.UInt32, "votes_b": pl.UInt32, "majority_probability": pl.Float64})
+
+
+def get_judgements(judge_responses: pl.LazyFrame, max_samples: int = 1) -> pl.LazyFrame:
+    # verdicts other than A or B are unparseable, they count as neither correct nor wrong. The majority of the sampled
+    # verdicts is the verdict of a judgement, a tie leaves it undecided. The logprobs judge has a single sample with
+    # the probability of answer A, which also gives the confidence of its verdict
+    votes = judge_responses.with_columns(
+        verdict=pl.col("raw_response").str.extract(f"(?i){JUDGE_VERDICT_PATTERN.pattern}", 1).str.to_uppercase(),
+    ).group_by("condition", "question_id", "judge_ordering").agg(
+        samples=pl.len(),
+        votes_a=(pl.col("verdict") == "A").sum(),
+        votes_b=(pl.col("verdict") == "B").sum(),
+        probability_a=pl.col("judge_probability_a").first(),
+    ).join(get_majority_probabilities(max_samples), on=["votes_a", "votes_b"], how="left")
+    return votes.with_columns(
+        is_correct_first=pl.col("judge_ordering").replace_strict(JUDGE_ORDERINGS, return_dtype=pl.Boolean),
+        unparseable_samples=pl.col("samples") - pl.col("votes_a") - pl.col("votes_b"),
+        verdict=pl.when(pl.col("votes_a") > pl.col("votes_b")).then(pl.lit("A"))
+        .when(pl.col("votes_b") > pl.col("votes_a")).then(pl.lit("B")),
+        confidence=pl.coalesce(
+            pl.max_horizontal(pl.col("probability_a"), 1 - pl.col("probability_a")),
+            pl.col("majority_probability"),
+        ),
+    ).drop("majority_probability").with_columns(
+        is_judge_correct=(pl.col("verdict") == "A") == pl.col("is_correct_first"),
+        correct_probability=pl.when(pl.col("is_correct_first")).then(pl.col("probability_a"))
+        .otherwise(1 - pl.col("probability_a")),
+    )
 
 
-if __name__ == '__main__':
-    unverified_files = []
-    verified_files = []
-
-    for file in os.listdir(JUDGE_RESULTS_DIR):
-        if file.startswith('unverified'):
-            unverified_files.append(os.path.join(JUDGE_RESULTS_DIR, file))
-        elif file.startswith('verified'):
-            verified_files.append(os.path.join(JUDGE_RESULTS_DIR, file))
-
-    correct_verified_judgements = get_file_results(verified_files)
-    correct_unverified_judgements = get_file_results(unverified_files)
-
-    verified_judgement_results = pl.from_dicts(correct_verified_judgements).with_columns(verified=1)
-    unverified_judgement_results = pl.from_dicts(correct_unverified_judgements).with_columns(verified=0)
-    print(f"Correct judge classification with quote verification system: {verified_judgement_results["is_judge_correct"].sum()}")
-    print(f"Correct judge classification without quote verification system: {unverified_judgement_results["is_judge_correct"].sum()}")
-
-    judgement_results = unverified_judgement_results.vstack(verified_judgement_results)
-
-    # sns.barplot(judgement_results, y="is_judge_correct", hue="verified", errorbar=None, legend=False, gap=.2)
-    # plt.xlim((-.4, .4))
-    # plt.ylim((.0, 1.))
-    # plt.ylabel("Correct Judgement")
-    # plt.xticks(ticks=[-0.2, .2], labels=["No", "Yes"])
-    # plt.xlabel("Uses verified quote system?")
-    # plt.savefig("data/quote_system_results.png")
-
-    joined_judgement_results = verified_judgement_results.drop("verified").join(unverified_judgement_results.drop("verified"),
-                                                                         on=["question_id", "is_correct_first"],
-                                                                         suffix="_unverified")
-    # Where did the quoting system improve the results where did it mislead the judge?
-    different_results = joined_judgement_results.filter(
+def get_condition_accuracy(judgements: pl.LazyFrame) -> pl.LazyFrame:
+    return judgements.group_by("condition").agg(
+        judgements=pl.len(),
+        samples_per_judgement=pl.col("samples").mean(),
+        unparseable_samples=pl.col("unparseable_samples").sum(),
+        undecided=pl.col("verdict").is_null().sum(),
+        correct=pl.col("is_judge_correct").sum(),
+        accuracy=pl.col("is_judge_correct").mean(),
+        confidence=pl.col("confidence").mean(),
+        correct_probability=pl.col("correct_probability").mean(),
+    ).sort("condition")
+
+
+def get_position_bias(judgements: pl.LazyFrame) -> pl.LazyFrame:
+    return judgements.group_by("condition", "is_correct_first").agg(
+        judgements=pl.col("verdict").is_not_null().sum(),
+        correct=pl.col("is_judge_correct").sum(),
+        accuracy=pl.col("is_judge_correct").mean(),
+        answer_a_share=(pl.col("verdict") == "A").mean(),
+        # the continuous counterparts of accuracy and answer_a_share, only for the logprobs judge
+        correct_probability=pl.col("correct_probability").mean(),
+        probability_a=pl.col("probability_a").mean(),
+    ).sort("condition", "is_correct_first", descending=[False, True])
+
+
+def get_verification_flips(judgements: pl.LazyFrame) -> pl.LazyFrame:
+    # judgements that changed between the unverified and the verified debate of the same question and ordering
+    key_columns = ["question_id", "is_correct_first"]
+    verified = judgements.filter(pl.col("condition") == VERIFIED_CONDITION).select(*key_columns, "is_judge_correct")
+    unverified = judgements.filter(pl.col("condition") == UNVERIFIED_CONDITION).select(*key_columns,
+                                                                                       "is_judge_correct")
+    return verified.join(unverified, on=key_columns, suffix="_unverified").filter(
         pl.col("is_judge_correct") != pl.col("is_judge_correct_unverified")
-    )
-    questions_with_different_results = different_results.select(
-        pl.col("question_id"),
-        pl.col("is_correct_first"),
-    ).sort(by="question_id")
-    print(f"{len(questions_with_different_results)} questions with different judgement results when using verified vs unverified quotes.")
-
-    judgement_mislead_by_quote_verification = different_results.filter(
-        pl.col("is_judge_correct") == 0
     ).select(
-        pl.col("question_id"),
-        pl.col("is_correct_first"),
-    ).sort(by="question_id")
-    print(f"In {len(judgement_mislead_by_quote_verification)} questions the quote verification made judgement worse.")
+        *key_columns,
+        pl.when(pl.col("is_judge_correct")).then(pl.lit("improved")).otherwise(pl.lit("worsened")).alias("change"),
+    ).sort(key_columns)
 
-    judgement_mislead_by_quote_verification = different_results.filter(
-        pl.col("is_judge_correct") == 1
-    ).select(
-        pl.col("question_id"),
-        pl.col("is_correct_first"),
-    ).sort(by="question_id")
-    print(f"In {len(judgement_mislead_by_quote_verification)} questions the quote verification improved judgement.")
-
-    correctly_judged_correct_answer_first = joined_judgement_results.filter(
-        pl.col("is_correct_first") == 1
-    ).sum().select(pl.col("is_judge_correct"), pl.col("is_judge_correct_unverified"))
-    correctly_judged_correct_answer_second = joined_judgement_results.filter(
-        pl.col("is_correct_first") == 0
-    ).sum().select(pl.col("is_judge_correct"), pl.col("is_judge_correct_unverified"))
-    print(f"{correctly_judged_correct_answer_first} questions are correctly judged with the correct answer displayed first.")
-    print(f"{correctly_judged_correct_answer_second} questions are correctly judged with the correct answer displayed second.")
-
-    concatted_judgement_results = pl.concat([
-        joined_judgement_results.with_columns(
-            pl.col("question_id"),
-            pl.col("is_correct_first"),
-            pl.col("is_judge_correct"),
-            verified=1,
-        ),
-        joined_judgement_results.with_columns(
-            pl.col("question_id"),
-            pl.col("is_correct_first"),
-            pl.col("is_judge_correct_unverified"),
-            verified=0,
-        ),
-    ])
 
+def plot_position_bias(position_bias: pl.DataFrame, file_path: str):
     plt.clf()
-    sns.barplot(concatted_judgement_results, x="verified", y="is_judge_correct", hue="is_correct_first", errorbar=None, legend=False)
+    sns.barplot(position_bias, x="condition", y="accuracy", hue="is_correct_first", hue_order=[False, True],
+                errorbar=None)
     plt.legend(title="Correct answer first?", labels=["No", "Yes"])
     plt.ylim((.0, 1.))
     plt.ylabel("Correct Judgement")
-    plt.xticks(ticks=[0, 1], labels=["No", "Yes"])
-    plt.xlabel("Uses verified quote system?")
-    plt.savefig("data/position_bias_results.png")
-    # plt.show()
+    plt.xlabel("Quote verification")
+    plt.savefig(file_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", choices=("files", "store"), default="files",
+                        help="Read the judge results from data/judge_results/ or from the results store.")
+    parser.add_argument("--run-id", help="Only evaluate this run of the results store.")
+    parser.add_argument("--judge-results-dir", default=JUDGE_RESULTS_DIR,
+                        help=f"Directory of the judge result files, {LOGPROB_JUDGE_RESULTS_DIR} for the results "
+                             f"of the logprobs judge.")
+    parser.add_argument("--plot-file", default="data/position_bias_results.png")
+    parser.add_argument("--flips-file", help="CSV file for the judgements that changed with quote verification.")
+    args = parser.parse_args()
+
+    if args.source == "files":
+        judge_responses = read_judge_result_files(args.judge_results_dir)
+    else:
+        judge_responses = scan_judge_results_store(run_id=args.run_id)
+    judgements = get_judgements(judge_responses, get_num_samples(judge_responses))
+
+    condition_accuracy, position_bias, verification_flips = pl.collect_all([
+        get_condition_accuracy(judgements),
+        get_position_bias(judgements),
+        get_verification_flips(judgements),
+    ])
 
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print("Judge accuracy per condition:")
+        print(condition_accuracy)
+        print("Judge accuracy by the position of the correct answer:")
+        print(position_bias)
+
+    print(f"{len(verification_flips)} questions with different judgement results when using verified vs unverified "
+          f"quotes.")
+    improved = verification_flips.filter(pl.col("change") == "improved")
+    worsened = verification_flips.filter(pl.col("change") == "worsened")
+    print(f"In {len(worsened)} questions the quote verification made judgement worse.")
+    print(f"In {len(improved)} questions the quote verification improved judgement.")
+    if args.flips_file is not None:
+        verification_flips.write_csv(args.flips_file)
+
+    plot_position_bias(position_bias, args.plot_file)
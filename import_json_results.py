@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import re
+
+from Debate import CONVERSATIONS_DIR, JUDGE_ORDERINGS, JUDGE_RESULTS_DIR, POST_HOC_VERIFIED_CONDITION
+from LLMAgent import LLMResponse
+from ResultsStore import ResultsStore
+from Transcript import extract_argument
+
+# one-shot import of the per question JSON files written before the results store existed
+RESULT_FILE_NAME_PATTERN = re.compile(
+    rf"^(partially_verified|verified|unverified|{POST_HOC_VERIFIED_CONDITION})_(\d+)\.json$")
+IMPORTED_RUN_ID = "imported"
+
+
+def get_result_files(results_dir: str) -> list[tuple[str, str, int]]:
+    # (file path, condition, question id)
+    if not os.path.isdir(results_dir):
+        return []
+
+    result_files = []
+    for file_name in sorted(os.listdir(results_dir)):
+        file_name_match = RESULT_FILE_NAME_PATTERN.match(file_name)
+        if file_name_match:
+            result_files.append((os.path.join(results_dir, file_name), file_name_match.group(1),
+                                 int(file_name_match.group(2))))
+    return result_files
+
+
+def import_conversations(results_store: ResultsStore, conversations_dir: str) -> int:
+    num_files = 0
+    for file_path, condition, question_id in get_result_files(conversations_dir):
+        with open(file_path, 'r') as f:
+            message_history = json.load(f)
+        # the files only contain the responses after quote verification, the raw responses are lost
+        for agent_id, agent_messages in message_history.items():
+            for debate_round, agent_message in enumerate(agent_messages):
+                agent_message, argument = extract_argument(agent_message)
+                results_store.add_argument(question_id, condition, debate_round, agent_id,
+                                           LLMResponse(agent_message), agent_message, argument)
+        num_files += 1
+    return num_files
+
+
+def import_judge_results(results_store: ResultsStore, judge_results_dir: str) -> int:
+    num_files = 0
+    for file_path, condition, question_id in get_result_files(judge_results_dir):
+        with open(file_path, 'r') as f:
+            judge_result = json.load(f)
+        # files with repeated judge samples hold all of them under "samples", the first one also at the top level,
+        # and files of the logprobs judge hold the probability of answer A under "probabilities"
+        judge_samples = judge_result.get("samples", {})
+        probabilities = judge_result.get("probabilities", {})
+        for judge_ordering in JUDGE_ORDERINGS:
+            if judge_ordering not in judge_result:
+                continue
+            for judge_sample, judge_response in enumerate(judge_samples.get(judge_ordering,
+                                                                            [judge_result[judge_ordering]])):
+                results_store.add_judgement(question_id, condition, judge_ordering, LLMResponse(judge_response),
+                                            judge_sample, probabilities.get(judge_ordering))
+        num_files += 1
+    return num_files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations-dir", default=CONVERSATIONS_DIR)
+    parser.add_argument("--judge-results-dir", default=JUDGE_RESULTS_DIR)
+    parser.add_argument("--run-id", default=IMPORTED_RUN_ID)
+    args = parser.parse_args()
+
+    store = ResultsStore(run_id=args.run_id)
+    num_conversations = import_conversations(store, args.conversations_dir)
+    num_judge_results = import_judge_results(store, args.judge_results_dir)
+    store.close()
+    print(f"Imported {num_conversations} conversations and {num_judge_results} judge results into "
+          f"{store.store_dir} as run {store.run_id}")
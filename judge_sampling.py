@@ -0,0 +1,50 @@
+import math
+
+from ResultsStore import get_judge_verdict
+
+DEFAULT_JUDGE_CONFIDENCE = .9
+# drawn in parallel before the first check, a unanimous first batch already reaches the default confidence
+MIN_JUDGE_SAMPLES = 3
+
+
+def count_votes(judge_responses: list[str]) -> tuple[int, int]:
+    verdicts = [get_judge_verdict(judge_response) for judge_response in judge_responses]
+    return verdicts.count("A"), verdicts.count("B")
+
+
+def get_majority_probability(votes_a: int, votes_b: int) -> float:
+    # probability that the verdict drawn more often is also the more likely one, for a uniform prior on the share of A
+    # verdicts, P(p > 1/2) of a Beta(a + 1, b + 1) posterior equals P(Binomial(a + b + 1, 1/2) <= a)
+    num_votes = votes_a + votes_b
+    majority_votes = max(votes_a, votes_b)
+    return sum(math.comb(num_votes + 1, i) for i in range(majority_votes + 1)) / 2 ** (num_votes + 1)
+
+
+def needs_more_samples(judge_responses: list[str], max_samples: int,
+                       confidence: float = DEFAULT_JUDGE_CONFIDENCE) -> bool:
+    num_samples = len(judge_responses)
+    if num_samples >= max_samples:
+        return False
+    if num_samples < min(MIN_JUDGE_SAMPLES, max_samples):
+        return True
+
+    votes_a, votes_b = count_votes(judge_responses)
+    # the remaining samples could not change the majority anymore
+    if abs(votes_a - votes_b) > max_samples - num_samples:
+        return False
+    return get_majority_probability(votes_a, votes_b) < confidence
+
+
+def get_num_next_samples(num_samples: int, max_samples: int) -> int:
+    return max(1, min(MIN_JUDGE_SAMPLES, max_samples) - num_samples)
+
+
+def get_answer_a_probability(top_logprobs: dict[str, float]) -> float | None:
+    # normalized over both answers, variants of the answer token like " A" or "a" count towards their answer
+    answer_probabilities = {"A": 0., "B": 0.}
+    for token, logprob in top_logprobs.items():
+        answer = token.strip().upper()
+        if answer in answer_probabilities:
+            answer_probabilities[answer] += math.exp(logprob)
+    total_probability = sum(answer_probabilities.values())
+    return answer_probabilities["A"] / total_probability if total_probability > 0 else None
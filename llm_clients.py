@@ -0,0 +1,64 @@
+import functools
+import importlib.util
+
+import httpx
+from openai import AsyncOpenAI
+
+SECRETS_FILE = "SECRETS"
+# local OpenAI compatible servers usually accept any key
+LOCAL_SERVER_API_KEY = "not-needed"
+
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 32
+DEFAULT_KEEPALIVE_EXPIRY = 60.
+
+# httpx only speaks HTTP/2 when the optional h2 package is installed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_clients: dict[tuple[str | None, str | None], AsyncOpenAI] = {}
+_pool_limits = httpx.Limits(
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    max_keepalive_connections=DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+)
+
+
+@functools.cache
+def load_api_keys(secrets_file: str = SECRETS_FILE) -> dict[str, str]:
+    api_keys = {}
+    with open(secrets_file, "r") as f:
+        for line in f.readlines():
+            line = line.split("=")
+            api_keys[line[0]] = line[1].rstrip()
+    return api_keys
+
+
+def configure_client_pool(max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                          max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY):
+    global _pool_limits
+    if _clients:
+        raise RuntimeError("The client pool has to be configured before the first client is created.")
+
+    _pool_limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+def get_client(api_key_name: str | None = "OPEN_AI_API_KEY", base_url: str | None = None) -> AsyncOpenAI:
+    client_key = (api_key_name, base_url)
+    if client_key not in _clients:
+        _clients[client_key] = AsyncOpenAI(
+            api_key=load_api_keys()[api_key_name] if api_key_name is not None else LOCAL_SERVER_API_KEY,
+            base_url=base_url,
+            http_client=httpx.AsyncClient(limits=_pool_limits, http2=HTTP2_AVAILABLE),
+        )
+    return _clients[client_key]
+
+
+async def close_clients():
+    for client in _clients.values():
+        await client.close()
+    _clients.clear()
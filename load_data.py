@@ -1,9 +1,15 @@
-import json
+import argparse
+import copy
+import hashlib
 import os
-from typing import Iterator
+import tempfile
+from dataclasses import asdict, dataclass
+from typing import Iterable, Iterator, NamedTuple
 
 import polars as pl
 
+from checkpoints import read_json, write_json_atomically
+
 DATASET_FILES = {
     'train': "data/QuALITY.v1.0.1/QuALITY.v1.0.1.htmlstripped.train",
     # 'test': "data/QuALITY.v1.0.1/QuALITY.v1.0.1.htmlstripped.test",
@@ -11,51 +17,188 @@ DATASET_FILES = {
 }
 
 PARSED_DATA_DIR = "data/parsed_data"
+# uncompressed arrow IPC files are memory mapped by polars instead of being parsed on every startup
+ARTICLE_DATA_FILE = "article_data.arrow"
+QUESTION_DATA_FILE = "question_data.arrow"
+MANIFEST_FILE = "manifest.json"
+LEGACY_ARTICLE_DATA_FILE = "article_data.csv"
+LEGACY_QUESTION_DATA_FILE = "question_data.csv"
+HASH_CHUNK_SIZE = 1 << 20
+
+
+@dataclass(frozen=True)
+class QuestionFilter:
+    # the filters of the original paper, None disables a threshold
+    require_writer_label_match: bool = True
+    require_unanimous_untimed_answers: bool = True
+    required_answerable_votes: int | None = 3
+    min_context_rating_sum: float | None = 4.5
+    max_speed_correct_votes: int | None = 2
+
+
+DEFAULT_QUESTION_FILTER = QuestionFilter()
+
+
+class Question(NamedTuple):
+    article: str
+    question: str
+    correct_answer: str
+    false_answer: str
+    question_id: int
 
 
 class Dataset:
-    def __init__(self):
-        if not os.path.exists(PARSED_DATA_DIR):
-            article_data, question_data = load_data()
-            os.makedirs(PARSED_DATA_DIR)
-            article_data.write_csv(os.path.join(PARSED_DATA_DIR, "article_data.csv"))
-            question_data.write_csv(os.path.join(PARSED_DATA_DIR, "question_data.csv"))
+    # question ids are row indices into question_data, slicing and sharding select a subset without copying the data
+    def __init__(self, question_ids: range | None = None, parsed_data_dir: str = PARSED_DATA_DIR,
+                 question_filter: QuestionFilter = DEFAULT_QUESTION_FILTER):
+        self.article_data, self.question_data, self.stage_counts = load_parsed_data(parsed_data_dir, question_filter)
+        self.article_rows: dict[int, int] = {article_id: row for row, article_id
+                                             in enumerate(self.article_data["article_id"])}
+        # stories are only copied out of the memory mapped file when a question needs them
+        self.articles: dict[int, str] = {}
+        self.questions = self.question_data.select("article_id", "question", "correct_answer", "false_answer").rows()
+        self.question_ids = question_ids if question_ids is not None else range(len(self.questions))
+
+    def __len__(self) -> int:
+        return len(self.question_ids)
+
+    def __getitem__(self, index: int | slice) -> "Question | Dataset":
+        if isinstance(index, slice):
+            return self.select(self.question_ids[index])
+        return self.get_question(self.question_ids[index])
+
+    def __iter__(self) -> Iterator[Question]:
+        for question_id in self.question_ids:
+            yield self.get_question(question_id)
+
+    def get_article(self, article_id: int) -> str:
+        if article_id not in self.articles:
+            self.articles[article_id] = self.article_data["article"][self.article_rows[article_id]]
+        return self.articles[article_id]
+
+    def get_question(self, question_id: int) -> Question:
+        article_id, question, correct_answer, false_answer = self.questions[question_id]
+        return Question(self.get_article(article_id), question, correct_answer, false_answer, question_id)
+
+    def select(self, question_ids: range) -> "Dataset":
+        dataset = copy.copy(self)
+        dataset.question_ids = question_ids
+        return dataset
+
+    def shard(self, shard_index: int, num_shards: int) -> "Dataset":
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"Shard {shard_index} does not exist with {num_shards} shards")
+        return self.select(self.question_ids[shard_index::num_shards])
+
+
+def get_file_hash(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_source_fingerprints(previous_fingerprints: dict[str, dict]) -> dict[str, dict]:
+    # only rehashes source files whose size or modification time changed, missing source files are skipped
+    fingerprints = {}
+    for dataset_path in DATASET_FILES.values():
+        if not os.path.isfile(dataset_path):
+            continue
+
+        stat = os.stat(dataset_path)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        previous_fingerprint = previous_fingerprints.get(dataset_path, {})
+        if all(previous_fingerprint.get(key) == value for key, value in fingerprint.items()):
+            fingerprint["sha256"] = previous_fingerprint["sha256"]
         else:
-            article_data = pl.read_csv(os.path.join(PARSED_DATA_DIR, "article_data.csv"))
-            question_data = pl.read_csv(os.path.join(PARSED_DATA_DIR, "question_data.csv"))
+            fingerprint["sha256"] = get_file_hash(dataset_path)
+        fingerprints[dataset_path] = fingerprint
+    return fingerprints
 
-        self.article_data = article_data
-        self.question_data = question_data
 
-    def __iter__(self) -> Iterator[tuple[str, str, list[str]]]:
-        for question in self.question_data.with_row_index().iter_rows():
-            article = self.article_data.filter(pl.col("article_id") == question[1]).select(pl.col("article")).item()
-            yield article, question[2], question[3], question[4], question[0]
+def write_ipc_atomically(data: pl.DataFrame, file_path: str):
+    # workers starting on a fresh cache build it at the same time, each one writes its own temporary file
+    file_descriptor, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", prefix=".",
+                                                       suffix=".tmp")
+    os.close(file_descriptor)
+    try:
+        data.write_ipc(temp_file_path)
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
 
 
-def load_dataset(path: str | os.PathLike[str]) -> tuple[pl.DataFrame, pl.DataFrame]:
-    # Questions filter from original paper:
-    # 1. 100% of untimed annotators chose the correct answer
-    # 2. Less than 50% of timed annotators chose the correct answer
-    # 3. All untimed annotators agree that the question is answerable and unambiguous
-    # 4. Average "context required" rating from untimed annotators is at least 1.5
-    # 5. Writer label matches the gold label
-    # 6. Compatible with 2-answer requirement
+def load_parsed_data(parsed_data_dir: str = PARSED_DATA_DIR, question_filter: QuestionFilter = DEFAULT_QUESTION_FILTER
+                     ) -> tuple[pl.DataFrame, pl.DataFrame, dict[str, int] | None]:
+    # the stage counts are None for data converted from the CSV cache
+    article_data_path = os.path.join(parsed_data_dir, ARTICLE_DATA_FILE)
+    question_data_path = os.path.join(parsed_data_dir, QUESTION_DATA_FILE)
+    manifest_path = os.path.join(parsed_data_dir, MANIFEST_FILE)
 
-    # For each question, we used the correct answer and the best ”distractor” answer. We removed questions that were
-    # incompatible with our 2-answer requirement, e.g. questions where one answer was ”all of the above”,
-    # ”none of the above”, etc.
+    manifest = read_json(manifest_path)
+    previous_fingerprints = manifest["sources"] if manifest is not None else {}
+    source_fingerprints = get_source_fingerprints(previous_fingerprints)
 
-    with open(path, 'r') as f:
-        data = list(map(json.loads, f.readlines()))
-        data = pl.from_dicts(data)
+    legacy_article_data_path = os.path.join(parsed_data_dir, LEGACY_ARTICLE_DATA_FILE)
+    legacy_question_data_path = os.path.join(parsed_data_dir, LEGACY_QUESTION_DATA_FILE)
+    # only the question table of the CSV cache is committed, the articles are parsed from the sources if necessary
+    has_legacy_data = os.path.isfile(legacy_question_data_path)
 
-    article_data = data.select(
-        pl.col("article_id").cast(pl.Int64),
-        pl.col("article").str.replace_all(r"\n", " ").str.replace_all(r"\s+", " "),
-    ).unique()
+    is_cached = manifest is not None and os.path.isfile(article_data_path) and os.path.isfile(question_data_path)
+    # manifests written before the filters were configurable used the default filter
+    is_same_filter = is_cached and manifest.get("question_filter", asdict(DEFAULT_QUESTION_FILTER)) == asdict(
+        question_filter)
+    # the results of earlier runs refer to the questions by their row in the parsed data, so another filter would
+    # silently give their ids to different questions
+    if (is_cached and not is_same_filter) or (has_legacy_data and question_filter != DEFAULT_QUESTION_FILTER):
+        raise ValueError(f"{parsed_data_dir} holds questions parsed with a different filter, use a separate parsed "
+                         f"data directory for every question subset")
+    if is_same_filter and all(fingerprint["sha256"] == previous_fingerprints.get(dataset_path, {}).get("sha256")
+                              for dataset_path, fingerprint in source_fingerprints.items()):
+        if any(fingerprint != previous_fingerprints[dataset_path]
+               for dataset_path, fingerprint in source_fingerprints.items()):
+            # the sources were touched but not changed, remember their new modification times
+            write_json_atomically(manifest_path, {**manifest,
+                                                  "sources": {**previous_fingerprints, **source_fingerprints}})
+        return pl.read_ipc(article_data_path), pl.read_ipc(question_data_path), manifest.get("stage_counts")
 
-    questions_data = data.select(
+    if has_legacy_data:
+        # the row order defines the question ids, so earlier results stay valid after the conversion. The questions
+        # are never parsed again, also not after the sources changed
+        question_data = pl.read_csv(legacy_question_data_path)
+        if os.path.isfile(legacy_article_data_path):
+            article_data = pl.read_csv(legacy_article_data_path)
+        elif len(source_fingerprints) == len(DATASET_FILES):
+            article_data = load_articles(question_data)
+        else:
+            raise FileNotFoundError(f"The articles of {legacy_question_data_path} need {legacy_article_data_path} or "
+                                    f"all QuALITY source files {list(DATASET_FILES.values())}")
+        missing_article_ids = set(question_data["article_id"]) - set(article_data["article_id"])
+        if missing_article_ids:
+            raise ValueError(f"The articles {sorted(missing_article_ids)} of {legacy_question_data_path} are missing, "
+                             f"its question ids can not be kept")
+        stage_counts = None
+    elif len(source_fingerprints) == len(DATASET_FILES):
+        if is_cached:
+            print("The QuALITY source files changed, parsing them again, question ids may differ from earlier runs")
+        article_data, question_data, stage_counts = load_data(question_filter)
+    else:
+        raise FileNotFoundError(f"Neither parsed data in {parsed_data_dir} nor all QuALITY source files "
+                                f"{list(DATASET_FILES.values())} were found")
+
+    os.makedirs(parsed_data_dir, exist_ok=True)
+    write_ipc_atomically(article_data, article_data_path)
+    write_ipc_atomically(question_data, question_data_path)
+    write_json_atomically(manifest_path, {"sources": source_fingerprints, "question_filter": asdict(question_filter),
+                                          "stage_counts": stage_counts})
+    return pl.read_ipc(article_data_path), pl.read_ipc(question_data_path), stage_counts
+
+
+def scan_questions(data: pl.LazyFrame) -> pl.LazyFrame:
+    return data.select(
         pl.col("article_id").cast(pl.Int64),
         pl.col("questions").list.eval(
             pl.element().struct.field("question")
@@ -97,35 +240,46 @@ def load_dataset(path: str | os.PathLike[str]) -> tuple[pl.DataFrame, pl.DataFra
         ).alias("speed_validation"),
     ).explode(pl.all().exclude("article_id"))
 
-    # writer label matches the gold label
-    questions_data = questions_data.filter(
-        pl.col("correct_answer_id") == pl.col("writer_label"),
-    ).drop("writer_label")
 
-    # 100% of untimed annotators chose correct answer
-    questions_data = questions_data.filter(
-        pl.col("untimed_answers").list.unique().list.len() == 1
-    ).drop("untimed_answers")
-
-    # all untimed annotators agree that the question is unambiguous and answerable
-    questions_data = questions_data.filter(
-        pl.col("is_answerable").list.eval(
-            pl.element() == 1
-        ).list.sum() == 3
-    ).drop("is_answerable")
+def get_filter_stages(question_filter: QuestionFilter) -> list[tuple[str, pl.Expr]]:
+    # Questions filter from original paper:
+    # 1. 100% of untimed annotators chose the correct answer
+    # 2. Less than 50% of timed annotators chose the correct answer
+    # 3. All untimed annotators agree that the question is answerable and unambiguous
+    # 4. Average "context required" rating from untimed annotators is at least 1.5
+    # 5. Writer label matches the gold label
+    # 6. Compatible with 2-answer requirement
 
-    # avg "context required" rating from untimed annotators is at least 1.5
-    questions_data = questions_data.filter(
-        pl.col("is_context_needed").list.sum() >= 4.5
-    ).drop("is_context_needed")
+    # For each question, we used the correct answer and the best ”distractor” answer. We removed questions that were
+    # incompatible with our 2-answer requirement, e.g. questions where one answer was ”all of the above”,
+    # ”none of the above”, etc.
 
-    # filter <50% chose correct answer for speed speed_validation
-    questions_data = questions_data.filter(
-        pl.col("speed_validation").list.concat(pl.col("correct_answer_id")).list.eval(
+    stages = []
+    if question_filter.require_writer_label_match:
+        stages.append(("writer_label_matches_gold_label", pl.col("correct_answer_id") == pl.col("writer_label")))
+    if question_filter.require_unanimous_untimed_answers:
+        # 100% of untimed annotators chose correct answer
+        stages.append(("unanimous_untimed_answers", pl.col("untimed_answers").list.unique().list.len() == 1))
+    if question_filter.required_answerable_votes is not None:
+        # all untimed annotators agree that the question is unambiguous and answerable
+        stages.append(("answerable", pl.col("is_answerable").list.eval(
+            pl.element() == 1
+        ).list.sum() == question_filter.required_answerable_votes))
+    if question_filter.min_context_rating_sum is not None:
+        # avg "context required" rating from untimed annotators is at least 1.5
+        stages.append(("context_required",
+                       pl.col("is_context_needed").list.sum() >= question_filter.min_context_rating_sum))
+    if question_filter.max_speed_correct_votes is not None:
+        # <50% chose correct answer for speed speed_validation, the concatenated correct answer always matches itself
+        stages.append(("hard_for_timed_annotators", pl.col("speed_validation").list.concat(
+            pl.col("correct_answer_id")
+        ).list.eval(
             pl.element() == pl.col("").last()
-        ).list.sum() < 4,
-    ).drop("speed_validation")
+        ).list.sum() - 1 <= question_filter.max_speed_correct_votes))
+    return stages
 
+
+def get_answers(questions_data: pl.LazyFrame) -> pl.LazyFrame:
     # TODO: get the best distractor id from untimed answers
     questions_data = questions_data.with_columns(
         pl.col("best_distractor").list.eval(
@@ -180,23 +334,82 @@ def load_dataset(path: str | os.PathLike[str]) -> tuple[pl.DataFrame, pl.DataFra
         ).list.get(pl.col("best_distractor_id")).alias("false_answer"),
     )
 
-    return article_data, questions_data
+    return questions_data
+
 
+def scan_data(question_filter: QuestionFilter = DEFAULT_QUESTION_FILTER,
+              dataset_paths: Iterable[str] = DATASET_FILES.values()) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+    # one lazy plan for all splits, the filters are applied in a single pass and the remaining rows are counted after
+    # every stage
+    data = pl.concat([pl.scan_ndjson(dataset_path, infer_schema_length=None) for dataset_path in dataset_paths])
 
-def load_data() -> tuple[pl.DataFrame, pl.DataFrame]:
-    article_datasets = []
-    question_datasets = []
+    stage_masks = {}
+    mask = pl.lit(True)
+    for stage_name, predicate in get_filter_stages(question_filter):
+        mask = mask & predicate
+        stage_masks[stage_name] = mask
 
-    for dataset_type, dataset_path in DATASET_FILES.items():
-        article_dataset, question_dataset = load_dataset(dataset_path)
-        article_datasets.append(article_dataset)
-        question_datasets.append(question_dataset)
+    questions_data = scan_questions(data)
+    stage_counts = questions_data.select(
+        questions=pl.len(),
+        **{stage_name: stage_mask.sum() for stage_name, stage_mask in stage_masks.items()},
+    )
+    questions_data = get_answers(questions_data.filter(mask)).unique(maintain_order=True)
+
+    article_data = scan_articles(data, questions_data)
 
-    article_dataset = pl.concat(article_datasets).unique()
-    question_dataset = pl.concat(question_datasets).unique()
+    return article_data, questions_data, stage_counts
 
-    article_dataset = article_dataset.filter(
-        pl.col("article_id").is_in(question_dataset.select(pl.col("article_id")).unique())
+
+def scan_articles(data: pl.LazyFrame, questions_data: pl.LazyFrame) -> pl.LazyFrame:
+    # only the articles of the given questions
+    return data.select(
+        pl.col("article_id").cast(pl.Int64),
+        pl.col("article").str.replace_all(r"\n", " ").str.replace_all(r"\s+", " "),
+    ).unique(maintain_order=True).join(
+        questions_data.select("article_id").unique(), on="article_id", how="semi", maintain_order="left",
     )
 
-    return article_dataset, question_dataset
+
+def load_articles(question_data: pl.DataFrame, dataset_paths: Iterable[str] = DATASET_FILES.values()
+                  ) -> pl.DataFrame:
+    data = pl.concat([pl.scan_ndjson(dataset_path, infer_schema_length=None) for dataset_path in dataset_paths])
+    return scan_articles(data, question_data.lazy()).collect()
+
+
+def load_data(question_filter: QuestionFilter = DEFAULT_QUESTION_FILTER) -> tuple[pl.DataFrame, pl.DataFrame,
+                                                                                   dict[str, int]]:
+    article_data, questions_data, stage_counts = pl.collect_all(scan_data(question_filter))
+    return article_data, questions_data, stage_counts.row(0, named=True)
+
+
+if __name__ == '__main__':
+    default_filter = QuestionFilter()
+    parser = argparse.ArgumentParser(
+        description="Parses the QuALITY questions with the given filters and reports the rows left after each filter.")
+    parser.add_argument("--parsed-data-dir", default=PARSED_DATA_DIR,
+                        help="Directory of the parsed data, use a separate one for every question subset.")
+    parser.add_argument("--no-writer-label-match", action="store_true",
+                        help="Keep questions whose writer label differs from the gold label.")
+    parser.add_argument("--no-unanimous-untimed-answers", action="store_true",
+                        help="Keep questions on which the untimed annotators disagree.")
+    parser.add_argument("--required-answerable-votes", type=int, default=default_filter.required_answerable_votes,
+                        help="Number of untimed annotators that have to rate the question as answerable, -1 disables "
+                             "the filter.")
+    parser.add_argument("--min-context-rating-sum", type=float, default=default_filter.min_context_rating_sum,
+                        help="Minimum sum of the context ratings of the untimed annotators, -1 disables the filter.")
+    parser.add_argument("--max-speed-correct-votes", type=int, default=default_filter.max_speed_correct_votes,
+                        help="Maximum number of timed annotators that chose the correct answer, -1 disables the filter.")
+    args = parser.parse_args()
+
+    dataset = Dataset(parsed_data_dir=args.parsed_data_dir, question_filter=QuestionFilter(
+        require_writer_label_match=not args.no_writer_label_match,
+        require_unanimous_untimed_answers=not args.no_unanimous_untimed_answers,
+        required_answerable_votes=args.required_answerable_votes if args.required_answerable_votes >= 0 else None,
+        min_context_rating_sum=args.min_context_rating_sum if args.min_context_rating_sum >= 0 else None,
+        max_speed_correct_votes=args.max_speed_correct_votes if args.max_speed_correct_votes >= 0 else None,
+    ))
+    stage_counts = dataset.stage_counts if dataset.stage_counts is not None else {}
+    for stage_name, count in stage_counts.items():
+        print(f"{stage_name}: {count}")
+    print(f"{len(dataset)} questions on {len(dataset.article_data)} articles in {args.parsed_data_dir}")
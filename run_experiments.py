@@ -1,21 +1,424 @@
-from Debate import Debate
+import argparse
+import asyncio
+import os
+from typing import Callable
+
+from BatchRunner import BatchRunner, LocalBatchTransport, OpenAIBatchTransport
+from Debate import Debate, JUDGE_ORDERINGS, PROMPT_LAYOUTS, PROMPT_LAYOUT_INLINE
+from DebateConfig import DebateConfig, JUDGE_MODES, JUDGE_MODE_ESSAY, JUDGE_MODE_LOGPROBS, NUM_DEBATE_ROUNDS, \
+    STOPPING_CONDITIONS, TURN_ORDERS, TURN_ORDER_SIMULTANEOUS, get_participants
+from LLMAgent import DEFAULT_MODEL, LLMAgent
+from ModelBackend import DEFAULT_COMPLETION_WORDS_MEDIAN, DEFAULT_LATENCY_MEDIAN, ModelBackend, OpenAIBackend, \
+    OpenAICompatibleBackend, ReplayBackend, SyntheticBackend
+from RequestScheduler import DEFAULT_MAX_RETRIES, DEFAULT_REQUEST_TIMEOUT, MODEL_PRICES, RequestScheduler, \
+    SpendLimitExceeded
+from ResponseCache import ResponseCache
+from ResultsStore import JUDGE_AGENT_ID, ResultsStore
+from Telemetry import TelemetrySink, get_telemetry_file_path
+from TokenBudget import TokenBudget
+from WorkQueue import DEFAULT_LEASE_TIME, WorkQueue, get_worker_id
+from checkpoints import gather_all
+from judge_sampling import DEFAULT_JUDGE_CONFIDENCE
+from llm_clients import close_clients, configure_client_pool
 from load_data import Dataset
 
 # investigate without the quote system
 # tried to mitigate self-defeating behaviour, but were unsuccessful
 
+# the first 102 questions, the range of the earlier runs
+DEFAULT_NUM_QUESTIONS = 102
+# (use_quote_verification, use_partial_quote_verification)
+QUOTE_VERIFICATION_CONDITIONS = ((True, False), (False, False))
+PARTIAL_QUOTE_VERIFICATION_CONDITION = (True, True)
+BACKENDS = ("openai", "openai-compatible", "synthetic", "replay")
+
+
+def load_debates(dataset: Dataset, agent: LLMAgent, prompt_layout: str, config: DebateConfig,
+                 results_store: ResultsStore, token_budget: TokenBudget | None = None) -> list[Debate]:
+    return [Debate(question_id=question.question_id, story=question.article, question=question.question,
+                   correct_answer=question.correct_answer, false_answer=question.false_answer, agent=agent,
+                   prompt_layout=prompt_layout, config=config, results_store=results_store,
+                   token_budget=token_budget)
+            for question in dataset]
+
+
+def get_conditions(include_partial_quote_verification: bool) -> list[tuple[bool, bool]]:
+    conditions = list(QUOTE_VERIFICATION_CONDITIONS)
+    if include_partial_quote_verification:
+        conditions.append(PARTIAL_QUOTE_VERIFICATION_CONDITION)
+    return conditions
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    # "i/N", the i-th of N shards counted from 0
+    shard_index, _, num_shards = shard.partition("/")
+    try:
+        shard_index, num_shards = int(shard_index), int(num_shards)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shards are given as i/N, not {shard}")
+    if not 0 <= shard_index < num_shards:
+        raise argparse.ArgumentTypeError(f"Shard {shard_index} does not exist with {num_shards} shards")
+    return shard_index, num_shards
+
+
+async def run_experiment(debate: Debate, include_partial_quote_verification: bool,
+                         include_post_hoc_quote_verification: bool, concurrency_limit: asyncio.Semaphore) -> bool:
+    async with concurrency_limit:
+        print(f"Starting experiment for question {debate.question_id}")
+        try:
+            for use_quote_verification, use_partial_quote_verification in get_conditions(
+                    include_partial_quote_verification):
+                await debate.start_discussion(use_quote_verification=use_quote_verification,
+                                              use_partial_quote_verification=use_partial_quote_verification)
+            if include_post_hoc_quote_verification:
+                debate.derive_post_hoc_discussion()
+            await debate.start_judging(include_partial_quote_verification, include_post_hoc_quote_verification)
+        except SpendLimitExceeded:
+            raise
+        except Exception as e:
+            # the other questions continue, a rerun resumes this one from its checkpoint
+            print(f"Experiment for question {debate.question_id} failed: {e!r}")
+            return False
+        print(f"Finished experiment for question {debate.question_id}")
+        return True
+
+
+async def run_queued_experiments(work_queue: WorkQueue, get_debate: Callable[[int], Debate],
+                                 include_partial_quote_verification: bool, include_post_hoc_quote_verification: bool,
+                                 concurrency: int):
+    # each of the concurrent loops claims the next free question once its previous one is done
+    worker_id = get_worker_id()
+    concurrency_limit = asyncio.Semaphore(concurrency)
+
+    async def run_worker():
+        while (question_id := work_queue.claim(worker_id)) is not None:
+            is_finished = False
+            try:
+                is_finished = await run_experiment(get_debate(question_id), include_partial_quote_verification,
+                                                   include_post_hoc_quote_verification, concurrency_limit)
+            finally:
+                if is_finished:
+                    work_queue.finish(question_id)
+                else:
+                    work_queue.release(question_id)
+
+    await gather_all(*[run_worker() for _ in range(concurrency)])
+
+
+async def run_batched_experiments(debates: list[Debate], batch_runner: BatchRunner, batch_debates: bool,
+                                  include_partial_quote_verification: bool, include_post_hoc_quote_verification: bool,
+                                  concurrency_limit: asyncio.Semaphore):
+    # a batch holds one request per judge ordering, the next samples depend on the verdicts of the previous ones
+    if any(debate.config.judge_samples > 1 for debate in debates):
+        raise ValueError("Repeated judge samples can not be batched, run them without --batch")
+    # batch requests use the sampling parameters of the agent, the logprobs judge needs its own
+    if any(debate.config.judge_mode == JUDGE_MODE_LOGPROBS for debate in debates):
+        raise ValueError("The logprobs judge can not be batched, run it without --batch")
+    conditions = get_conditions(include_partial_quote_verification)
+    for use_quote_verification, use_partial_quote_verification in conditions:
+        condition = Debate.get_condition_name(use_quote_verification, use_partial_quote_verification)
+        unfinished_debates = [debate for debate in debates
+                              if not debate.is_discussion_finished(use_quote_verification,
+                                                                   use_partial_quote_verification)]
+
+        if not batch_debates:
+            async def run_discussion(debate: Debate):
+                async with concurrency_limit:
+                    await debate.start_discussion(use_quote_verification=use_quote_verification,
+                                                  use_partial_quote_verification=use_partial_quote_verification)
+
+            await asyncio.gather(*map(run_discussion, unfinished_debates))
+            continue
+
+        for debate in unfinished_debates:
+            if debate.config.turn_order != TURN_ORDER_SIMULTANEOUS:
+                raise ValueError("Only simultaneous debates can batch the debater prompts of a round")
+            debate.resume_discussion(use_quote_verification, use_partial_quote_verification)
+
+        # resumed debates continue from different rounds, so a batch holds the next round of every debate
+        batch_step = 0
+        while True:
+            for debate in unfinished_debates:
+                if debate.is_transcript_complete(debate.transcript):
+                    debate.finish_discussion(use_quote_verification, use_partial_quote_verification)
+            unfinished_debates = [debate for debate in unfinished_debates
+                                  if not debate.is_transcript_complete(debate.transcript)]
+            if not unfinished_debates:
+                break
+            print(f"Batching the next debate round of {len(unfinished_debates)} {condition} debates")
+
+            round_prompts = {
+                debate.question_id: debate.get_round_prompts(debate.transcript.num_rounds, use_quote_verification,
+                                                             use_partial_quote_verification)
+                for debate in unfinished_debates
+            }
+            requests = {}
+            call_infos = {}
+            for debate in unfinished_debates:
+                for agent_id, agent_prompt in round_prompts[debate.question_id].items():
+                    requests[f"{debate.question_id}-{agent_id}"] = agent_prompt
+                    call_infos[f"{debate.question_id}-{agent_id}"] = debate.get_call_info(
+                        agent_id, use_quote_verification, use_partial_quote_verification,
+                        debate_round=debate.transcript.num_rounds)
+
+            responses = await batch_runner.get_responses(f"{condition}_step_{batch_step}", requests, call_infos)
+            for debate in unfinished_debates:
+                debate.add_responses({
+                    agent_id: responses[f"{debate.question_id}-{agent_id}"]
+                    for agent_id in round_prompts[debate.question_id]
+                }, use_quote_verification, use_partial_quote_verification)
+            batch_step += 1
+
+    if include_post_hoc_quote_verification:
+        for debate in debates:
+            debate.derive_post_hoc_discussion()
+
+    for used_quote_verification, used_partial_quote_verification, post_hoc_quote_verification in \
+            Debate.get_judge_conditions(include_partial_quote_verification, include_post_hoc_quote_verification):
+        condition = Debate.get_condition_name(used_quote_verification, used_partial_quote_verification,
+                                              post_hoc_quote_verification)
+        unjudged_debates = [debate for debate in debates
+                            if not debate.is_judging_finished(used_quote_verification, used_partial_quote_verification,
+                                                              post_hoc_quote_verification)]
+        if not unjudged_debates:
+            continue
+        print(f"Batching judgements of {len(unjudged_debates)} {condition} debates")
+
+        requests = {}
+        call_infos = {}
+        for debate in unjudged_debates:
+            debate.load_discussion(used_quote_verification, used_partial_quote_verification,
+                                   post_hoc_quote_verification)
+            debate.resume_judging(used_quote_verification, used_partial_quote_verification,
+                                  post_hoc_quote_verification)
+            for judge_ordering in debate.get_pending_judge_orderings():
+                requests[f"{debate.question_id}-{judge_ordering}"] = debate.get_judge_messages(
+                    JUDGE_ORDERINGS[judge_ordering], used_partial_quote_verification)
+                call_infos[f"{debate.question_id}-{judge_ordering}"] = debate.get_call_info(
+                    JUDGE_AGENT_ID, used_quote_verification, used_partial_quote_verification,
+                    judge_ordering=judge_ordering, post_hoc_quote_verification=post_hoc_quote_verification)
+
+        responses = await batch_runner.get_responses(f"{condition}_judge", requests, call_infos)
+        for debate in unjudged_debates:
+            for judge_ordering in debate.get_pending_judge_orderings():
+                debate.add_judge_response(judge_ordering, responses[f"{debate.question_id}-{judge_ordering}"],
+                                          used_quote_verification, used_partial_quote_verification,
+                                          post_hoc_quote_verification)
+            debate.save_judge_progress(used_quote_verification, used_partial_quote_verification,
+                                       post_hoc_quote_verification)
+
+
+def get_backend(args: argparse.Namespace, config: DebateConfig) -> ModelBackend:
+    if args.backend == "openai-compatible":
+        if args.base_url is None:
+            raise ValueError("The openai-compatible backend needs --base-url")
+        return OpenAICompatibleBackend(args.base_url, args.api_key_name)
+    if args.backend == "synthetic":
+        return SyntheticBackend(seed=args.seed, latency_median=args.synthetic_latency,
+                                completion_words_median=args.synthetic_words)
+    if args.backend == "replay":
+        if args.replay_dir is None:
+            raise ValueError("The replay backend needs --replay-dir")
+        # the recorded debates of the same configuration
+        return ReplayBackend(os.path.join(args.replay_dir, "conversations", config.get_directory_name()),
+                             os.path.join(args.replay_dir, "logprob_judge_results"
+                                          if args.judge_mode == JUDGE_MODE_LOGPROBS else "judge_results",
+                                          config.get_directory_name()))
+    return OpenAIBackend()
+
+
+async def run_experiments(args: argparse.Namespace, cache: ResponseCache, results_store: ResultsStore):
+    scheduler = RequestScheduler(requests_per_minute=args.requests_per_minute,
+                                 tokens_per_minute=args.tokens_per_minute, max_retries=args.max_retries,
+                                 request_timeout=args.request_timeout, max_spend=args.max_spend)
+    telemetry_name = results_store.run_id
+    # parallel workers of a run write separate telemetry files, telemetry_report.py reads them together
+    if args.shard is not None or args.work_queue is not None:
+        telemetry_name += f"-{get_worker_id()}"
+    telemetry = TelemetrySink(args.telemetry_file if args.telemetry_file is not None
+                              else get_telemetry_file_path(telemetry_name))
+    config = DebateConfig(
+        num_rounds=args.num_rounds,
+        participants=get_participants(args.debaters_per_side),
+        turn_order=args.turn_order,
+        stopping_condition=STOPPING_CONDITIONS[args.stop_when] if args.stop_when is not None else None,
+        judge_samples=args.judge_samples,
+        judge_confidence=args.judge_confidence,
+        judge_mode=args.judge_mode,
+    )
+    backend = get_backend(args, config)
+    agent = LLMAgent(cache=cache, model=args.model, scheduler=scheduler, stream=args.stream, backend=backend,
+                     telemetry=telemetry)
+    dataset = Dataset()[args.first_question:args.first_question + args.num_questions]
+    if args.shard is not None:
+        dataset = dataset.shard(*args.shard)
+    token_budget = None
+    # without a limit the prompt sections are neither tokenized nor reported
+    if any(max_tokens is not None for max_tokens in (args.max_story_tokens, args.max_transcript_tokens,
+                                                      args.max_argument_tokens)):
+        token_budget = TokenBudget(args.model, args.max_story_tokens, args.max_transcript_tokens,
+                                   args.max_argument_tokens)
+    concurrency_limit = asyncio.Semaphore(args.concurrency)
+
+    try:
+        if args.work_queue is not None:
+            # the debates are only created for the questions this worker claims
+            work_queue = WorkQueue(args.work_queue, results_store.run_id, args.lease_time)
+            work_queue.add(dataset.question_ids)
+            try:
+                await run_queued_experiments(
+                    work_queue,
+                    lambda question_id: load_debates(dataset.select(range(question_id, question_id + 1)), agent,
+                                                     args.prompt_layout, config, results_store, token_budget)[0],
+                    args.partial_quote_verification, args.post_hoc_quote_verification, args.concurrency)
+                print(f"Work queue of run {results_store.run_id}: {work_queue.get_counts()}")
+            finally:
+                work_queue.close()
+        elif args.batch is None:
+            debates = load_debates(dataset, agent, args.prompt_layout, config, results_store, token_budget)
+            await asyncio.gather(*[run_experiment(debate, args.partial_quote_verification,
+                                                  args.post_hoc_quote_verification, concurrency_limit)
+                                   for debate in debates])
+        else:
+            debates = load_debates(dataset, agent, args.prompt_layout, config, results_store, token_budget)
+            if args.batch == "openai":
+                if not isinstance(backend, OpenAIBackend):
+                    raise ValueError("The batch API needs an OpenAI backend, use --batch local instead")
+                batch_transport = OpenAIBatchTransport(backend.client)
+            else:
+                batch_transport = LocalBatchTransport(backend, concurrency=args.concurrency)
+            await run_batched_experiments(debates, BatchRunner(agent, batch_transport), args.batch_debates,
+                                          args.partial_quote_verification, args.post_hoc_quote_verification,
+                                          concurrency_limit)
+    finally:
+        await close_clients()
+        results_store.close()
+        telemetry.close()
+
+    usage_summary = agent.get_usage_summary()
+    print(f"{usage_summary['calls']} API calls used {usage_summary['prompt_tokens']} prompt tokens "
+          f"({usage_summary['cached_token_share']:.1%} cached) and {usage_summary['completion_tokens']} completion tokens")
+    print(f"Scheduler: {scheduler.retries} retries, {scheduler.rate_limit_errors} rate limit errors, "
+          f"${scheduler.spent:.4f} spent")
+    # a run whose results were all finished already makes no calls
+    if os.path.isfile(telemetry.file_path):
+        print(f"Per call telemetry written to {telemetry.file_path}, summarize it with telemetry_report.py")
+    if token_budget is not None:
+        for section, section_summary in token_budget.get_summary().items():
+            print(f"Prompt section {section}: {section_summary['mean_tokens']:.0f} tokens on average, at most "
+                  f"{section_summary['max_tokens']}, {section_summary['truncated']} of {section_summary['sections']} "
+                  f"truncated")
+
+
 if __name__ == '__main__':
-    data = Dataset()
-    for article, question, correct_answer, false_answer, question_id in data:
-        print(f"Starting experiment for question {question_id + 1}")
-        debate = Debate(question_id=question_id, story=article, question=question, correct_answer=correct_answer,
-                        false_answer=false_answer)
-        debate.start_discussion(use_quote_verification=True)
-        debate.start_discussion(use_quote_verification=False)
-        debate.start_judging()
-        print()
-
-        if question_id > 100:
-            break
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Maximum number of questions debated at the same time. 1 runs the questions sequentially.")
+    parser.add_argument("--max-connections", type=int, default=64,
+                        help="Size of the shared HTTP connection pool of the LLM client.")
+    parser.add_argument("--backend", choices=BACKENDS, default="openai",
+                        help="'synthetic' generates deterministic fake responses and 'replay' serves the responses of "
+                             "an earlier run, both without network access.")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--base-url",
+                        help="Chat completions server of the openai-compatible backend, e.g. http://localhost:8000/v1.")
+    parser.add_argument("--api-key-name",
+                        help="Name of the key in the SECRETS file for the openai-compatible backend, if it needs one.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic backend.")
+    parser.add_argument("--synthetic-latency", type=float, default=DEFAULT_LATENCY_MEDIAN,
+                        help="Median seconds per response of the synthetic backend, log-normally distributed.")
+    parser.add_argument("--synthetic-words", type=int, default=DEFAULT_COMPLETION_WORDS_MEDIAN,
+                        help="Median words per response of the synthetic backend, log-normally distributed.")
+    parser.add_argument("--replay-dir",
+                        help="Data directory of an earlier run with conversations/ and judge_results/ to replay. "
+                             "Use a copy, the files of this run are written to data/.")
+    parser.add_argument("--requests-per-minute", type=float,
+                        help="Requests per minute admitted by the scheduler, set slightly below the provider limit.")
+    parser.add_argument("--tokens-per-minute", type=float,
+                        help="Estimated prompt and completion tokens per minute admitted by the scheduler.")
+    parser.add_argument("--max-retries", type=int, default=DEFAULT_MAX_RETRIES,
+                        help="Retries of rate limited, timed out and failed requests with jittered backoff.")
+    parser.add_argument("--request-timeout", type=float, default=DEFAULT_REQUEST_TIMEOUT,
+                        help="Seconds before a single request is cancelled and retried.")
+    parser.add_argument("--max-spend", type=float,
+                        help="Stop the experiments before the API costs in USD of this run exceed this ceiling.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream the responses and cancel them once the argument or the judge's answer is "
+                             "complete. Token counts of cancelled responses are estimated.")
+    parser.add_argument("--bypass-cache", action="store_true",
+                        help="Always query the API, but still store the fresh responses in the response cache.")
+    parser.add_argument("--cache-size-mb", type=int, default=512,
+                        help="Maximum size of the on-disk response cache before old responses are evicted.")
+    parser.add_argument("--first-question", type=int, default=0,
+                        help="Index of the first question of the dataset to run.")
+    parser.add_argument("--num-questions", type=int, default=DEFAULT_NUM_QUESTIONS,
+                        help="Number of consecutive questions to run, starting at --first-question.")
+    parser.add_argument("--prompt-layout", choices=PROMPT_LAYOUTS, default=PROMPT_LAYOUT_INLINE,
+                        help="'prefix' moves the story into a leading message shared by both debaters and all rounds.")
+    parser.add_argument("--num-rounds", type=int, default=NUM_DEBATE_ROUNDS,
+                        help="Maximum number of debate rounds. Debates whose rounds, debaters, turn order or stopping "
+                             "condition differ from the defaults are stored in a subdirectory per configuration.")
+    parser.add_argument("--debaters-per-side", type=int, default=1,
+                        help="Number of debaters arguing for each of the two answers.")
+    parser.add_argument("--turn-order", choices=TURN_ORDERS, default=TURN_ORDER_SIMULTANEOUS,
+                        help="'sequential' lets every debater see the arguments already given in the current round.")
+    parser.add_argument("--stop-when", choices=STOPPING_CONDITIONS.keys(),
+                        help="End a debate early once all debaters concede and/or repeat their previous argument.")
+    parser.add_argument("--max-story-tokens", type=int,
+                        help="Truncate longer stories to their first this many tokens.")
+    parser.add_argument("--max-transcript-tokens", type=int,
+                        help="Truncate longer transcripts to their last this many tokens, for debaters and judge.")
+    parser.add_argument("--max-argument-tokens", type=int,
+                        help="Truncate every argument shown in a transcript to its first this many tokens.")
+    parser.add_argument("--partial-quote-verification", action="store_true",
+                        help="Additionally run a condition that marks near matches of the story as partially "
+                             "verified <p_quote> quotes.")
+    parser.add_argument("--post-hoc-quote-verification", action="store_true",
+                        help="Additionally judge the unverified debates with their quotes verified afterwards, which "
+                             "needs no further debater calls.")
+    parser.add_argument("--judge-mode", choices=JUDGE_MODES, default=JUDGE_MODE_ESSAY,
+                        help="'logprobs' lets the judge answer with a single token and stores the probability of "
+                             "answer A from its logprobs, in data/logprob_judge_results/.")
+    parser.add_argument("--judge-samples", type=int, default=1,
+                        help="Maximum number of judge verdicts per ordering, their majority is the judgement.")
+    parser.add_argument("--judge-confidence", type=float, default=DEFAULT_JUDGE_CONFIDENCE,
+                        help="With --judge-samples, stop sampling once the majority verdict is this likely to be the "
+                             "one the judge gives most often.")
+    parser.add_argument("--shard", type=parse_shard,
+                        help="Only run every N-th question starting with the i-th, given as i/N with i counted from 0. "
+                             "Start one process per shard, on one or several machines.")
+    parser.add_argument("--work-queue",
+                        help="SQLite file of a work queue, e.g. data/work_queue.sqlite. Every process started with the "
+                             "same file and --run-id claims the next free question until none are left.")
+    parser.add_argument("--lease-time", type=float, default=DEFAULT_LEASE_TIME,
+                        help="Seconds after which a question claimed from the work queue by a crashed worker is "
+                             "claimed again.")
+    parser.add_argument("--run-id",
+                        help="Name of the run in the results store, defaults to the start time of the run.")
+    parser.add_argument("--telemetry-file",
+                        help="JSONL file for the per call telemetry, defaults to data/telemetry/<run id>.jsonl.")
+    parser.add_argument("--batch", choices=("openai", "local"),
+                        help="Collect the judge prompts of all questions into batch files. 'openai' submits them to "
+                             "the batch API, 'local' processes them through the chat completions endpoint.")
+    parser.add_argument("--batch-debates", action="store_true",
+                        help="With --batch, also batch the debater prompts of each round across all questions.")
+    args = parser.parse_args()
+    if (args.shard is not None or args.work_queue is not None) and args.run_id is None:
+        raise ValueError("Parallel workers need a shared --run-id, so that their results form one run")
+    if args.max_spend is not None and args.model not in MODEL_PRICES:
+        raise ValueError(f"No prices known for {args.model}, --max-spend needs its prices in MODEL_PRICES")
+    if args.work_queue is not None and args.batch is not None:
+        raise ValueError("A batch needs all questions up front, it can not claim them from a work queue")
+
+    configure_client_pool(max_connections=args.max_connections,
+                          max_keepalive_connections=args.max_connections)
+
+    response_cache = ResponseCache(max_size=args.cache_size_mb * 1024 * 1024, bypass=args.bypass_cache)
+    results_store = ResultsStore(run_id=args.run_id)
+    asyncio.run(run_experiments(args, response_cache, results_store))
+    print(f"Results stored in {results_store.store_dir} as run {results_store.run_id}")
+    print(f"Response cache: {response_cache.hits} hits, {response_cache.misses} misses")
+    response_cache.close()
 
     print("Finished experiments.")
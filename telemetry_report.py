@@ -0,0 +1,85 @@
+import argparse
+import glob
+import os
+
+import polars as pl
+
+from Telemetry import TELEMETRY_DIR
+
+THROUGHPUT_INTERVAL = "1m"
+
+
+def load_telemetry(file_paths: list[str]) -> pl.LazyFrame:
+    return pl.concat([pl.scan_ndjson(file_path, infer_schema_length=None) for file_path in file_paths],
+                     how="diagonal_relaxed").with_columns(
+        is_judge=pl.col("role") == "judge",
+        total_tokens=pl.col("prompt_tokens") + pl.col("completion_tokens"),
+    )
+
+
+def get_latency_summary(telemetry: pl.LazyFrame) -> pl.LazyFrame:
+    return telemetry.filter(pl.col("error").is_null()).group_by("is_judge", "from_cache").agg(
+        calls=pl.len(),
+        wall_time_p50=pl.col("wall_time").quantile(.5),
+        wall_time_p95=pl.col("wall_time").quantile(.95),
+        queue_time_p50=pl.col("queue_time").quantile(.5),
+        queue_time_p95=pl.col("queue_time").quantile(.95),
+        time_to_first_token_p50=pl.col("time_to_first_token").quantile(.5),
+        retries=pl.col("retries").sum(),
+    ).sort("is_judge", "from_cache")
+
+
+def get_condition_summary(telemetry: pl.LazyFrame) -> pl.LazyFrame:
+    # tokens and cost per question, split into debaters and judge
+    per_question = telemetry.group_by("condition", "question_id").agg(
+        debater_tokens=pl.col("total_tokens").filter(~pl.col("is_judge")).sum(),
+        judge_tokens=pl.col("total_tokens").filter(pl.col("is_judge")).sum(),
+        cost=pl.col("cost").sum(),
+        errors=pl.col("error").is_not_null().sum(),
+    )
+    return per_question.group_by("condition").agg(
+        questions=pl.len(),
+        debater_tokens_per_question=pl.col("debater_tokens").mean(),
+        judge_tokens_per_question=pl.col("judge_tokens").mean(),
+        cost=pl.col("cost").sum(),
+        cost_per_question=pl.col("cost").mean(),
+        errors=pl.col("errors").sum(),
+    ).sort("condition")
+
+
+def get_throughput(telemetry: pl.LazyFrame, interval: str = THROUGHPUT_INTERVAL) -> pl.LazyFrame:
+    return telemetry.with_columns(
+        started_at=pl.from_epoch(pl.col("started_at"), time_unit="s"),
+    ).sort("started_at").group_by_dynamic("started_at", every=interval).agg(
+        calls=pl.len(),
+        errors=pl.col("error").is_not_null().sum(),
+        retries=pl.col("retries").sum(),
+        total_tokens=pl.col("total_tokens").sum(),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*",
+                        help=f"Telemetry files to summarize, defaults to all files in {TELEMETRY_DIR}.")
+    parser.add_argument("--interval", default=THROUGHPUT_INTERVAL,
+                        help="Width of the throughput buckets, e.g. 10s, 1m or 1h.")
+    args = parser.parse_args()
+
+    telemetry_files = args.files or sorted(glob.glob(os.path.join(TELEMETRY_DIR, "*.jsonl")))
+    if not telemetry_files:
+        raise FileNotFoundError(f"No telemetry files found in {TELEMETRY_DIR}")
+    telemetry_data = load_telemetry(telemetry_files)
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        latency_summary, condition_summary, throughput = pl.collect_all([
+            get_latency_summary(telemetry_data),
+            get_condition_summary(telemetry_data),
+            get_throughput(telemetry_data, args.interval),
+        ])
+        print("Latency in seconds by role:")
+        print(latency_summary)
+        print("Tokens and cost per condition:")
+        print(condition_summary)
+        print(f"Throughput per {args.interval}:")
+        print(throughput)